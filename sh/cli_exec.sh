@@ -20,3 +20,12 @@ python -m spacy train source/config_spacy/config_dl.cfg \
 	--verbose  \
 	--gpu-id 0 \
 	--output model/spacy_sentiment 
+
+# Check the import time of the light modules against their budget. 
+python -m source.modules.model_registry 
+
+# Publish the scoring models (mlpipe_estim, best_estimator) from the regression notebook first: 
+#   publish_best_model(df_performances, X_train, mlpipe_topic=mlpipe_topic, mlpipe_spacy=mlpipe_spacy) 
+# Serve the scoring of live headlines (JSON lines on stdin/stdout, or HTTP). 
+python -m source.modules.processor_scoring --mode stdio 
+python -m source.modules.processor_scoring --mode http --port 8765 
@@ -1,6 +1,4 @@
-import optuna 
-import xgboost as xgb
-from sklearn.linear_model import ElasticNet 
+import threading 
 
 
 
@@ -15,6 +13,10 @@ DIR_DATASET_LABELLINGS = f"{DIR_DATASET}/labelling"
 DIR_MLSPACY = "model/spacy_sentiment/v1" 
 DIR_MLTOPIC = "model/topic_modelling" 
 DIR_MLESTIM = "model/mktmv_estimator" 
+DIR_CACHE = f"{DIR_DATASET}/cache" 
+
+# Block size (in bytes) read at a time when streaming the raw CSV files. 
+PARAM_CSV_BLOCK_SIZE = 16 << 20 
 
 # Define th starting and ending date when collecting the ticker data. 
 TICKER_DATE_COLLECT = "1998-12-01", "2022-03-21" 
@@ -35,10 +37,66 @@ PARAM_SEED = 42
 PARAM_THRESHOLD = 0.8 
 PARAM_LANG = "en" 
 
+# Wikifier client. The token bucket allows (PARAM_WIKIFIER_RATE) requests per 
+# second on average with bursts of up to (PARAM_WIKIFIER_BURST) requests. 
+PARAM_WIKIFIER_WORKERS = 4 
+PARAM_WIKIFIER_RATE = 1.0 
+PARAM_WIKIFIER_BURST = 4 
+PARAM_WIKIFIER_RETRIES = 5 
+PARAM_WIKIFIER_BACKOFF = 1.0 
+PARAM_WIKIFIER_CHUNK = 50 
+
+# Wikifier rejects texts above 25,000 characters. Longer articles are split on 
+# sentence boundaries into chunks of at most this size. 
+PARAM_WIKIFIER_MAX_CHARS = 20000 
+
 # Define the # of topics. 
 PARAM_N_TOPIC = 8 
 PARAM_TOP_N_TERM = 20 
 
+# Width of the hashed entity vectors. Fixed, so the fitted vectorizer does 
+# not grow with the # of entities seen. 
+PARAM_HASH_N_FEATURES = 2 ** 18 
+
+# Market movement labels. The t-score of the log return is taken against its 
+# rolling mean/std over (PARAM_MKT_WINDOW) trading days and bucketed into 
+# 0 (<= low), 1 and 2 (>= high) by (PARAM_MKT_THRESHOLDS). 
+PARAM_MKT_WINDOW = 365 
+PARAM_MKT_MIN_PERIODS = 365 
+PARAM_MKT_THRESHOLDS = (0.25, 0.75) 
+PARAM_MKT_LAGS = (1, 2, 3) 
+
+# News published at or after the cutoff (exchange local time) or on a day 
+# without trading are aligned to the next trading session. 
+PARAM_NEWS_CUTOFF = "16:00" 
+PARAM_NEWS_TZ = "America/New_York" 
+
+# SpaCy batched inference. Only the pipes listed here are kept when 
+# streaming texts through (nlp.pipe), the rest are disabled. 
+PARAM_SPACY_BATCH_SIZE = 256 
+PARAM_SPACY_N_PROCESS = 1 
+PARAM_SPACY_KEEP_PIPES = ("tok2vec", "transformer", "textcat", "textcat_multilabel") 
+
+# Sentiment labels of the textcat and the # of docs per (DocBin) shard when 
+# saving the training sets. 
+SENTIMENT_LABELS = ("positive", "negative", "neutral") 
+PARAM_DOCBIN_SHARD_SIZE = 10_000 
+
+# Maximum # of entries kept in the on-disk transform cache before the 
+# least recently used ones are evicted. 
+PARAM_CACHE_MAX_ENTRIES = 1_000_000 
+
+# Maximum # of texts memoized in memory by the SHAP predictor and tokenizer. 
+PARAM_SHAP_CACHE_SIZE = 100_000 
+
+# Scoring service. Incoming headlines are scored together once the batch holds 
+# (PARAM_SCORING_MAX_BATCH) headlines or the oldest one waited for 
+# (PARAM_SCORING_MAX_LATENCY) seconds. 
+PARAM_SCORING_MAX_BATCH = 64 
+PARAM_SCORING_MAX_LATENCY = 0.05 
+PARAM_SCORING_HOST = "127.0.0.1" 
+PARAM_SCORING_PORT = 8765 
+
 # -------------------------------------------------------
 # For multiverse analysis 
 # -------------------------------------------------------
@@ -46,6 +104,17 @@ PARAM_TOP_N_TERM = 20
 # Number of trials to run the hyperparameter optimisation. 
 EXPERIMENT_TRIAL = 25 
 
+# Storage for resuming the Optuna studies and the pruner to stop a trial early 
+# once its first folds are clearly worse. The pruner only starts judging a 
+# trial after (EXPERIMENT_PRUNE_WARMUP) folds. The storage is opt-in: pass it to 
+# the multiverse analysis to resume its studies. The parallel runs use the 
+# journal file instead, since the processes would lock each other out of the 
+# SQLite file. 
+EXPERIMENT_STORAGE = f"sqlite:///{DIR_MLESTIM}/optuna_studies.db" 
+EXPERIMENT_STORAGE_PARALLEL = f"journal:///{DIR_MLESTIM}/optuna_studies.log" 
+EXPERIMENT_PRUNER = "median" 
+EXPERIMENT_PRUNE_WARMUP = 3 
+
 # Define different set of components. 
 EXPERIMENT_COMPS = [
 	["newstheme"], 
@@ -57,50 +126,85 @@ EXPERIMENT_COMPS = [
 	["newstheme", "sentiment", "autocorrs"], 
 ]
 
-# Assign different model choices and default parameters to experiment with. 
-EXPERIMENT_MODEL = {
-	# ElasticNet. 
-	"els": {
-		"model": ElasticNet(
-			alpha=1, l1_ratio=.5, max_iter=5000, random_state=PARAM_SEED
-		), 
-		"param_dist": {
-			"l1_ratio"  : [.5, .3, .1], 
+# Import time budget (in seconds) of the light modules, checked by 
+# (python -m source.modules.model_registry). 
+IMPORT_TIME_BUDGET = {
+	"source.config_py.config"           : 0.1, 
+	"source.modules.model_registry"     : 0.2, 
+	"source.modules.processor_spacy"    : 0.2, 
+}
+
+# -------------------------------------------------------
+# Deferred constants 
+# -------------------------------------------------------
+
+# The estimators are only constructed (and optuna, xgboost and sklearn only 
+# imported) the first time (EXPERIMENT_MODEL) is accessed. 
+_lock_deferred = threading.Lock() 
+
+
+def _build_experiment_model() -> dict: 
+	'''Assign different model choices and default parameters to experiment with.''' 
+
+	import optuna 
+	import xgboost as xgb
+	from sklearn.linear_model import ElasticNet 
+
+	return {
+		# ElasticNet. 
+		"els": {
+			"model": ElasticNet(
+				alpha=1, l1_ratio=.5, max_iter=5000, random_state=PARAM_SEED
+			), 
+			"param_dist": {
+				"l1_ratio"  : [.5, .3, .1], 
+			}, 
+			"bayes_opt": False, 
 		}, 
-		"bayes_opt": False, 
-	}, 
-
-	# Random Forest. 
-	"rfr": {
-		"model": xgb.XGBRFRegressor(
-			learning_rate=1, n_estimators=100, max_depth=8, base_score=0.5, 
-			colsample_bynode=.5, reg_lambda=0.1, reg_alpha=1.0, min_split_loss=0.05,
-			min_child_weight=1, subsample=0.5, tree_method="auto", booster="gbtree", 
-			num_parallel_tree=2, objective="reg:squarederror", eval_metric="rmse", 
-			seed=PARAM_SEED, 
-		), 
-		"param_dist": {
-			"max_depth"         : optuna.distributions.IntUniformDistribution(3, 8), 
-			"n_estimators"      : optuna.distributions.IntUniformDistribution(100, 500), 
-			"min_child_weight"  : optuna.distributions.IntUniformDistribution(1, 20), 
+
+		# Random Forest. 
+		"rfr": {
+			"model": xgb.XGBRFRegressor(
+				learning_rate=1, n_estimators=100, max_depth=8, base_score=0.5, 
+				colsample_bynode=.5, reg_lambda=0.1, reg_alpha=1.0, min_split_loss=0.05,
+				min_child_weight=1, subsample=0.5, tree_method="auto", booster="gbtree", 
+				num_parallel_tree=2, objective="reg:squarederror", eval_metric="rmse", 
+				seed=PARAM_SEED, 
+			), 
+			"param_dist": {
+				"max_depth"         : optuna.distributions.IntUniformDistribution(3, 8), 
+				"n_estimators"      : optuna.distributions.IntUniformDistribution(100, 500), 
+				"min_child_weight"  : optuna.distributions.IntUniformDistribution(1, 20), 
+			}, 
+			"bayes_opt": True, 
 		}, 
-		"bayes_opt": True, 
-	}, 
-
-	# XGBoost. 
-	"xgb": {
-		"model": xgb.XGBRegressor(
-			learning_rate=0.001, n_estimators=100, max_depth=8, base_score=0.5, 
-			reg_lambda=0.1, reg_alpha=1.0, min_split_loss=0.05, min_child_weight=1, 
-			subsample=0.5, tree_method="auto", booster="gbtree", num_parallel_tree=2, 
-			objective="reg:squarederror", eval_metric="rmse", seed=PARAM_SEED, 
-		), 
-		"param_dist": {
-			"learning_rate"     : optuna.distributions.LogUniformDistribution(1e-4, 1e-2), 
-			"max_depth"         : optuna.distributions.IntUniformDistribution(3, 8), 
-			"n_estimators"      : optuna.distributions.IntUniformDistribution(100, 500), 
-			"min_child_weight"  : optuna.distributions.IntUniformDistribution(1, 20), 
+
+		# XGBoost. 
+		"xgb": {
+			"model": xgb.XGBRegressor(
+				learning_rate=0.001, n_estimators=100, max_depth=8, base_score=0.5, 
+				reg_lambda=0.1, reg_alpha=1.0, min_split_loss=0.05, min_child_weight=1, 
+				subsample=0.5, tree_method="auto", booster="gbtree", num_parallel_tree=2, 
+				objective="reg:squarederror", eval_metric="rmse", seed=PARAM_SEED, 
+			), 
+			"param_dist": {
+				"learning_rate"     : optuna.distributions.LogUniformDistribution(1e-4, 1e-2), 
+				"max_depth"         : optuna.distributions.IntUniformDistribution(3, 8), 
+				"n_estimators"      : optuna.distributions.IntUniformDistribution(100, 500), 
+				"min_child_weight"  : optuna.distributions.IntUniformDistribution(1, 20), 
+			}, 
+			"bayes_opt": True, 
 		}, 
-		"bayes_opt": True, 
-	}, 
-}
+	} 
+
+
+def __getattr__(name:str): 
+	'''Build the deferred constants on first access (PEP 562).''' 
+
+	if name == "EXPERIMENT_MODEL": 
+		with _lock_deferred: 
+			if name not in globals(): 
+				globals()[name] = _build_experiment_model() 
+		return globals()[name] 
+
+	raise AttributeError(f"module {__name__!r} has no attribute {name!r}") 
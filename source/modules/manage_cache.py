@@ -0,0 +1,166 @@
+# %%
+# Python modules.
+import os, json, time, hashlib, sqlite3, contextlib
+import numpy as np
+import pandas as pd
+
+# Custom modules.
+from source.modules.manage_files import ManageFiles
+
+# Custom configuration.
+from source.config_py.config import DIR_CACHE, PARAM_CACHE_MAX_ENTRIES
+
+
+
+# %%
+class ManageCache(ManageFiles):
+	def __init__(self, model_version:str, filename:str="transform_cache.sqlite", cache_dir:str=DIR_CACHE, max_entries:int=PARAM_CACHE_MAX_ENTRIES):
+		'''
+		Persistent content-addressed cache for transformer outputs. Each entry is
+		keyed by a hash of (model version, namespace, input value), so changing the
+		model version invalidates the previous entries automatically. The least
+		recently used entries are evicted once (max_entries) is exceeded.
+		'''
+		super().__init__(dataset_dir=cache_dir)
+
+		self.model_version = model_version
+		self.filename = filename
+		self.max_entries = max_entries
+		self.hits = 0
+		self.misses = 0
+
+
+	def make_key(self, value, namespace:str="") -> str:
+		'''Hash the model version, namespace and input value into a cache key.'''
+
+		payload = json.dumps([self.model_version, namespace, value], default=_to_serializable, sort_keys=True)
+		return hashlib.sha256(payload.encode("utf8")).hexdigest()
+
+
+	def get_many(self, keys:list) -> dict:
+		'''Look up the keys and return the cached values found.'''
+
+		found = dict()
+		with self._connect() as conn:
+			for i in range(0, len(keys), 500):
+				chunk = keys[i:i+500]
+				marks = ",".join("?" * len(chunk))
+				rows = conn.execute(f"SELECT key, value FROM cache WHERE key IN ({marks})", chunk).fetchall()
+				found.update({key: json.loads(value) for key, value in rows})
+
+				# Refresh the access time of the hits for the LRU eviction.
+				if rows:
+					hit_keys = [key for key, _ in rows]
+					marks = ",".join("?" * len(hit_keys))
+					conn.execute(f"UPDATE cache SET last_access = ? WHERE key IN ({marks})", [time.time()] + hit_keys)
+		return found
+
+
+	def set_many(self, keys:list, values:list):
+		'''Store the values and evict the least recently used entries if needed.'''
+
+		now = time.time()
+		with self._connect() as conn:
+			conn.executemany(
+				"INSERT OR REPLACE INTO cache (key, value, last_access) VALUES (?, ?, ?)",
+				[(key, json.dumps(value, default=_to_serializable), now) for key, value in zip(keys, values)],
+			)
+
+			# Evict the oldest entries beyond the size bound.
+			if self.max_entries:
+				n_entries = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+				if n_entries > self.max_entries:
+					conn.execute(
+						"DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY last_access ASC LIMIT ?)",
+						(n_entries - self.max_entries,),
+					)
+
+
+	def lookup_or_compute(self, values:pd.Series, func, namespace:str="") -> np.array:
+		'''
+		Return the cached output for each value and only pass the missing ones
+		(deduplicated) to (func). The (func) receives a (pd.Series) and should
+		return one output per value in the same order.
+		'''
+
+		# Deduplicate the inputs by their keys.
+		keys = [self.make_key(value, namespace) for value in values]
+		unique_pos = dict()
+		for i, key in enumerate(keys):
+			unique_pos.setdefault(key, i)
+
+		found = self.get_many(list(unique_pos))
+		missing = [key for key in unique_pos if key not in found]
+
+		# Compute and store the missing outputs.
+		if missing:
+			computed = func(values.iloc[[unique_pos[key] for key in missing]])
+			computed = [_to_serializable(value) for value in computed]
+			self.set_many(missing, computed)
+			found.update(zip(missing, computed))
+
+		# Track the hit/miss counts per input row.
+		n_missing = len(missing)
+		self.misses += n_missing
+		self.hits += len(keys) - n_missing
+		print(f"Cache ({namespace}): hits ({len(keys) - n_missing}), misses ({n_missing})")
+
+		return np.array([found[key] for key in keys], dtype=object)
+
+
+	def stats(self) -> dict:
+		'''Report the hit/miss counts and the current size of the cache.'''
+
+		with self._connect() as conn:
+			n_entries = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+		total = self.hits + self.misses
+		return {
+			"hits"      : self.hits,
+			"misses"    : self.misses,
+			"hit_rate"  : self.hits / total if total else 0.0,
+			"entries"   : n_entries,
+		}
+
+
+	def clear(self):
+		'''Remove every entry from the cache.'''
+
+		with self._connect() as conn:
+			conn.execute("DELETE FROM cache")
+		self.hits, self.misses = 0, 0
+
+
+	@contextlib.contextmanager
+	def _connect(self):
+		'''
+		Open the cache database. A new connection is opened for each operation so
+		that the transformers holding the cache can be pickled and used in
+		worker processes.
+		'''
+
+		# Check directories.
+		self._get_ready_for_file_operation()
+
+		conn = sqlite3.connect(os.path.join(self.dataset_dir, self.filename), timeout=60)
+		try:
+			with conn:
+				conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, last_access REAL NOT NULL)")
+				conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON cache (last_access)")
+				yield conn
+		finally:
+			conn.close()
+
+
+
+# %%
+def _to_serializable(value):
+	'''Convert NumPy objects into plain Python objects for JSON.'''
+
+	if isinstance(value, np.ndarray):
+		return value.tolist()
+	if isinstance(value, np.generic):
+		return value.item()
+	if isinstance(value, (set, tuple)):
+		return list(value)
+	return value
@@ -1,12 +1,35 @@
 # %%
 # Python modules. 
-import os, re, pickle 
+import os, re, json, time, uuid, shutil, pickle, hashlib 
+import numpy as np 
 import pandas as pd
+import pyarrow as pa 
+import pyarrow.csv as pa_csv 
+import pyarrow.compute as pa_compute 
+import pyarrow.parquet as pq 
 import spacy 
 from spacy.tokens import DocBin 
 
 # Custom configuration.
-from source.config_py.config import DIR_DATASET
+from source.config_py.config import (
+	DIR_DATASET, PARAM_CSV_BLOCK_SIZE, SENTIMENT_LABELS, 
+	PARAM_SPACY_BATCH_SIZE, PARAM_SPACY_N_PROCESS, PARAM_DOCBIN_SHARD_SIZE 
+)
+
+
+
+# %%
+# Columns and types of the raw CNN articles CSV. 
+CNN_CSV_TYPES = {
+	"Date published"   : pa.timestamp("s"), 
+	"Url"              : pa.string(), 
+	"Category"         : pa.string(), 
+	"Section"          : pa.string(), 
+	"Headline"         : pa.string(), 
+	"Second headline"  : pa.string(), 
+	"Description"      : pa.string(), 
+	"Article text"     : pa.string(), 
+}
 
 
 
@@ -72,6 +95,175 @@ class ManageFiles():
 		return df
 
 
+	def read_dataset(self, filename:str=None, columns:list=None, filters:list=None, as_arrow:bool=False, memory_map:bool=True, **kwargs):
+		'''
+		Read a parquet file (or a partitioned parquet directory) loading only the given 
+		columns and the rows matching the filters. Both are pushed down to the parquet 
+		reader, so the skipped columns, row groups and partitions are never read. The 
+		filters follow the (pyarrow) format, e.g. (date_filter) for a date range or 
+		[("category", "==", "business")]. Set (as_arrow) to get the memory-mapped 
+		Arrow table instead of a pandas copy. 
+		'''
+
+		print(f"Read from ({filename})") 
+
+		# Check directories. 
+		self._get_ready_for_file_operation()
+
+		# Read files. The pandas index columns are kept along with the given columns. 
+		filepath = os.path.join(self.dataset_dir, filename) 
+		table = pq.read_table(filepath, columns=columns, filters=filters, memory_map=memory_map, use_pandas_metadata=True, **kwargs) 
+		return table if as_arrow else table.to_pandas() 
+
+
+	def write_to_dataset(self, data:pd.DataFrame, dirname:str=None, date_col:str="date", **kwargs):
+		'''
+		Append the dataframe to a Hive-style partitioned parquet directory laid out as 
+		(year=YYYY/month=M) from the (date_col). Only the partitions touched by the new 
+		rows receive a new file, the existing files are never rewritten. The new files 
+		are staged under hidden names first and renamed once all of them are written. 
+		Each file is named after the hash of its content, so retrying an append that was 
+		interrupted halfway replaces the files already published instead of adding 
+		the rows twice. Rows without a date have no partition and raise a (ValueError), filter them 
+		out beforehand. Returns the # of rows written. 
+		'''
+
+		print(f"Write to ({dirname})") 
+
+		# Check directories. 
+		self._get_ready_for_file_operation()
+
+		dirpath = os.path.join(self.dataset_dir, dirname) 
+		dates = pd.to_datetime(data[date_col]) 
+
+		n_null = int(dates.isna().sum()) 
+		if n_null: 
+			raise ValueError(f"({n_null}) rows have no ({date_col}) and cannot be partitioned.") 
+
+		# Stage one file per touched partition. The keys are cast to int so that the 
+		# partitions read back as integers. The staged files left by a failure are removed. 
+		staged = [] 
+		try: 
+			for (year, month), df_part in data.groupby([dates.dt.year.astype(int), dates.dt.month.astype(int)]): 
+				partpath = os.path.join(dirpath, f"year={year}", f"month={month}") 
+				os.makedirs(partpath, exist_ok=True) 
+
+				tmppath = os.path.join(partpath, f".part-{uuid.uuid4().hex}.tmp") 
+				staged.append(tmppath) 
+				pq.write_table(pa.Table.from_pandas(df_part, preserve_index=True), tmppath, **kwargs) 
+
+			# Publish the staged files. Readers ignore the hidden files until then. 
+			for tmppath in staged: 
+				os.replace(tmppath, os.path.join(os.path.dirname(tmppath), f"part-{_hash_file(tmppath)}.parquet")) 
+		finally: 
+			for tmppath in staged: 
+				if os.path.exists(tmppath): 
+					os.remove(tmppath) 
+
+		print(f"Appended ({len(data)}) rows to ({len(staged)}) partitions.") 
+		return len(data) 
+
+
+	def compact_dataset(self, dirname:str=None, min_files:int=2, **kwargs):
+		'''
+		Merge the small files of each partition holding at least (min_files) files into 
+		a single file. The merged file is published in the same partition before the 
+		original files are removed, so the partition never goes missing for readers. 
+		A hidden marker lists the files being replaced until they are removed, and a 
+		compaction interrupted in between is completed on the next run. 
+		'''
+
+		print(f"Compact ({dirname})") 
+
+		# Check directories. 
+		self._get_ready_for_file_operation()
+
+		dirpath = os.path.join(self.dataset_dir, dirname) 
+		for root, _, files in os.walk(dirpath): 
+			if os.path.basename(root).startswith("."): 
+				continue 
+
+			# Complete the compactions interrupted before removing the original files. 
+			for marker in sorted(f for f in files if f.startswith(".compact-")): 
+				_complete_compaction(root, marker) 
+
+			# Merge the files in the order they were written. 
+			parts = [f for f in os.listdir(root) if f.endswith(".parquet") and not f.startswith(".")] 
+			parts = sorted(parts, key=lambda f: (os.path.getmtime(os.path.join(root, f)), f)) 
+			if len(parts) < min_files: 
+				continue 
+
+			table = _concat_tables([pq.read_table(os.path.join(root, f)) for f in parts]) 
+			filename = f"part-compacted-{_hash_names(parts)}.parquet" 
+			tmppath = os.path.join(root, f".{filename}.tmp") 
+			pq.write_table(table, tmppath, **kwargs) 
+
+			# Mark the files to replace, publish the merged file and remove them. 
+			marker = f".compact-{_hash_names(parts)}.json" 
+			_write_atomic(os.path.join(root, marker), json.dumps({"compacted": filename, "parts": parts})) 
+			os.replace(tmppath, os.path.join(root, filename)) 
+			_complete_compaction(root, marker) 
+
+			print(f"Compacted ({len(parts)}) files in ({root}).") 
+
+
+	def ingest_csv_to_dataset(self, filename:str=None, dirname:str=None, column_types:dict=CNN_CSV_TYPES, category:str="business", block_size:int=PARAM_CSV_BLOCK_SIZE, compact:bool=True):
+		'''
+		Stream the raw CNN articles CSV into a partitioned parquet dataset. The CSV is 
+		parsed block by block by the Arrow reader with explicit types, and each block is 
+		filtered on (category), renamed and appended via (write_to_dataset), so the peak 
+		memory is bounded by (block_size) rather than the file size. The row position 
+		in the CSV is kept as (headline_id), like the index of (read_from_csv). The quoted 
+		fields (e.g. the article text) may span several lines. The rows 
+		without a publication date cannot be partitioned and are rejected, their # is 
+		reported at the end. 
+		'''
+
+		print(f"Ingest ({filename}) into ({dirname})") 
+
+		# Check directories. 
+		self._get_ready_for_file_operation()
+
+		filepath = os.path.join(self.dataset_dir, filename) 
+		reader = pa_csv.open_csv(
+			filepath, 
+			read_options=pa_csv.ReadOptions(block_size=block_size), 
+			parse_options=pa_csv.ParseOptions(newlines_in_values=True), 
+			convert_options=pa_csv.ConvertOptions(include_columns=list(column_types), column_types=column_types), 
+		) 
+
+		n_read, n_written, n_rejected = 0, 0, 0 
+		for batch in reader: 
+			table = pa.Table.from_batches([batch]) 
+			table = table.append_column("headline_id", pa.array(range(n_read, n_read + table.num_rows), type=pa.int64())) 
+			n_read += table.num_rows 
+
+			# Filter the news category. 
+			if category is not None: 
+				table = table.filter(pa_compute.equal(table["Category"], category)) 
+			if table.num_rows == 0: 
+				continue 
+
+			# Rename columns and process datetime. 
+			df_chunk = table.to_pandas().set_index("headline_id") 
+			df_chunk.columns = [c.lower().replace(" ", "_") for c in df_chunk.columns] 
+			df_chunk["date"] = df_chunk["date_published"].dt.normalize() 
+
+			# Reject the rows without a publication date. 
+			missing = df_chunk["date"].isna() 
+			n_rejected += int(missing.sum()) 
+			if missing.all(): 
+				continue 
+
+			n_written += self.write_to_dataset(df_chunk[~missing], dirname=dirname) 
+
+		print(f"Ingested ({n_written}) of ({n_read}) rows, rejected ({n_rejected}) rows without a date.") 
+
+		# Merge the small files written per block. 
+		if compact: 
+			self.compact_dataset(dirname) 
+
+
 	def save_cache_pk(self, dir:str=None, filename:str=None, object=None): 
 		'''Cache the result.''' 
 
@@ -129,8 +321,8 @@ class ManageFiles():
 
 		# Load the model specific version and get the dev folder. 
 		dev_status, version = self.resume_version(dir, dev_status=dev_status) 
-		version_load = str(version) if version_load == "latest" else version_load 
-		obj_name = f"{obj_name}_v{int(version) - 1}.pickle" 
+		version_load = int(version) - 1 if version_load == "latest" else int(version_load) 
+		obj_name = f"{obj_name}_v{version_load}.pickle" 
 
 		# Load the model. 
 		path = os.path.join(dir, dev_status, obj_name) 
@@ -138,14 +330,148 @@ class ManageFiles():
 			return pickle.load(f) 
 
 
-	def save_to_spacy(self, data:spacy.tokens.doc.Doc, filename:str, nlp:spacy.tokens.doc.Doc): 
-		'''Save dataset in SpaCy format.'''
+	def save_artifact(self, dir:str=None, obj_name:str=None, object=None, dev_status:bool=True) -> int: 
+		'''
+		Save the object as a new version in the artifact store and return the version. 
+		Pass a (dict) of parts (e.g. {"vectorizer": ..., "model": ...}) to be able to 
+		load each part on its own later. The numeric arrays (e.g. NMF components_, 
+		TF-IDF idf_) and the fitted (vocabulary_) dicts are stored as (.npy) files next to a small 
+		pickle, and a manifest lists the parts. The version is written to a hidden 
+		directory first and published with a single rename. 
+		''' 
+
+		print(f"Save artifact ({obj_name}).") 
+
+		# Check directories. 
+		self._get_ready_for_file_operation() 
+
+		dev_status = "dev" if dev_status else "prod" 
+		objpath = os.path.join(dir, dev_status, obj_name) 
+		os.makedirs(objpath, exist_ok=True) 
+
+		# Write every part into a staging directory. 
+		tmppath = os.path.join(objpath, f".tmp-{uuid.uuid4().hex}") 
+		os.makedirs(tmppath) 
+		parts = object if isinstance(object, dict) else {"object": object} 
+		manifest = {"obj_name": obj_name, "created_at": time.strftime("%Y-%m-%d %H:%M:%S"), "single": not isinstance(object, dict), "parts": {}} 
+		for part_name, part in parts.items(): 
+			with open(os.path.join(tmppath, f"{part_name}.pickle"), "wb") as f: 
+				pickler = ArrayPickler(f, tmppath, prefix=part_name) 
+				pickler.dump(part) 
+			manifest["parts"][part_name] = {"pickle": f"{part_name}.pickle", "arrays": pickler.arrays} 
+
+		# Publish the version. The rename fails if another process took the same version. 
+		while True: 
+			version = max(self.list_artifact_versions(dir, obj_name, dev_status == "dev") or [0]) + 1 
+			manifest["version"] = version 
+			with open(os.path.join(tmppath, "manifest.json"), "w") as f: 
+				json.dump(manifest, f, indent=4) 
+			verpath = os.path.join(objpath, f"v{version}") 
+			try: 
+				os.rename(tmppath, verpath) 
+				break 
+			except OSError: 
+				if not os.path.exists(verpath): 
+					raise 
+
+		# Point the latest version to the new one. 
+		_write_atomic(os.path.join(objpath, "LATEST"), str(version)) 
+		print(f"Published version: ({version}) in ({dev_status})") 
+		return version 
+
+
+	def load_artifact(self, dir:str=None, obj_name:str=None, version_load:str="latest", parts:list=None, mmap:bool=True, dev_status:bool=True): 
+		'''
+		Load the object of specific version from the artifact store. Only the given 
+		(parts) are loaded (all by default). The numeric arrays are memory-mapped 
+		copy-on-write, so loading them is near-instant and their pages are shared 
+		between the processes loading the same version until written. The 
+		vocabularies are rebuilt as dicts from their arrays, which is faster than 
+		unpickling them but not shared. 
+		''' 
+
+		print(f"Load artifact ({obj_name}).") 
+
+		# Check directories. 
+		self._get_ready_for_file_operation() 
+
+		dev_status = "dev" if dev_status else "prod" 
+		objpath = os.path.join(dir, dev_status, obj_name) 
+		if version_load == "latest": 
+			with open(os.path.join(objpath, "LATEST"), "r") as f: 
+				version_load = f.read().strip() 
+
+		verpath = os.path.join(objpath, f"v{int(version_load)}") 
+		with open(os.path.join(verpath, "manifest.json"), "r") as f: 
+			manifest = json.load(f) 
+
+		# Load the requested parts only. 
+		loaded = dict() 
+		for part_name in (parts or manifest["parts"]): 
+			with open(os.path.join(verpath, manifest["parts"][part_name]["pickle"]), "rb") as f: 
+				loaded[part_name] = ArrayUnpickler(f, verpath, mmap=mmap).load() 
+
+		print(f"Loaded version: ({version_load}) from ({dev_status})") 
+		return loaded["object"] if manifest["single"] and parts is None else loaded 
+
+
+	def list_artifact_versions(self, dir:str=None, obj_name:str=None, dev_status:bool=True) -> list: 
+		'''List the published versions of the object.''' 
+
+		dev_status = "dev" if dev_status else "prod" 
+		objpath = os.path.join(dir, dev_status, obj_name) 
+		if not os.path.exists(objpath): 
+			return [] 
+		return sorted(int(d[1:]) for d in os.listdir(objpath) if re.match(r"^v\d+$", d)) 
+
+
+	def save_to_spacy(self, data:list, filename:str, nlp:spacy.language.Language, n_process:int=PARAM_SPACY_N_PROCESS, batch_size:int=PARAM_SPACY_BATCH_SIZE, shard_size:int=PARAM_DOCBIN_SHARD_SIZE, keep_pipes:tuple=()): 
+		'''
+		Save dataset in SpaCy format. The (text, label) tuples are streamed through 
+		(nlp.pipe) and written as (DocBin) shards of (shard_size) docs. A dataset 
+		fitting in one shard is saved as the single (filename) file, as before, so 
+		the DVC entries of the existing datasets still apply. A larger one becomes 
+		the (filename) directory of shards, which (spacy train) reads as one corpus 
+		(run (dvc add) again on it). Only the pipes in (keep_pipes) run, the textcat 
+		training only needs the tokens. The shards are staged and swapped in once 
+		complete. 
+		'''
 		
 		print(f"Save to ({filename})") 
 
+		# Check directories. 
+		self._get_ready_for_file_operation()
+
 		path = os.path.join(self.dataset_dir, filename) 
-		doc_bin = DocBin(docs=to_spacy_document(nlp, data)) 
-		doc_bin.to_disk(path) 
+		tmppath = os.path.join(self.dataset_dir, f".{filename}.{uuid.uuid4().hex[:8]}.tmp") 
+		os.makedirs(tmppath) 
+
+		# Write a shard each time (shard_size) docs are collected. 
+		n_docs, n_shards = 0, 0 
+		doc_bin = DocBin(store_user_data=False) 
+		for doc in to_spacy_document(nlp, data, n_process=n_process, batch_size=batch_size, keep_pipes=keep_pipes): 
+			doc_bin.add(doc) 
+			n_docs += 1 
+			if len(doc_bin) >= shard_size: 
+				doc_bin.to_disk(os.path.join(tmppath, f"shard-{n_shards:05d}.spacy")) 
+				doc_bin, n_shards = DocBin(store_user_data=False), n_shards + 1 
+
+		if len(doc_bin) or not n_shards: 
+			doc_bin.to_disk(os.path.join(tmppath, f"shard-{n_shards:05d}.spacy")) 
+			n_shards += 1 
+
+		# Replace the previous dataset, a single file or a directory of shards. 
+		if os.path.isdir(path): 
+			shutil.rmtree(path) 
+		if n_shards == 1: 
+			os.replace(os.path.join(tmppath, "shard-00000.spacy"), path) 
+			os.rmdir(tmppath) 
+		else: 
+			if os.path.exists(path): 
+				os.remove(path) 
+			os.replace(tmppath, path) 
+
+		print(f"Saved ({n_docs}) docs in ({n_shards}) shards.") 
 
 
 	def update_version(self, dir:str=None, version:int=None, dev_status:bool=True): 
@@ -156,10 +482,9 @@ class ManageFiles():
 		
 		dev_status = "dev" if dev_status else "prod" 
 		path = os.path.join(dir, dev_status, "VERSION") 
-		with open(path, "w") as f: 
-			version += 1 
-			print(f"Updated version: ({version}) in ({dev_status})") 
-			f.write(str(version)) 
+		version += 1 
+		_write_atomic(path, str(version)) 
+		print(f"Updated version: ({version}) in ({dev_status})") 
 
 
 	def resume_version(self, dir:str=None, dev_status:bool=True): 
@@ -215,35 +540,209 @@ class ManageFiles():
 
 
 # %%
-def to_spacy_document(nlp:spacy.tokens.doc.Doc, data:tuple) -> spacy.tokens.doc.Doc: 
+class ArrayPickler(pickle.Pickler): 
+	def __init__(self, file, array_dir:str, prefix:str="object", min_size:int=1000): 
+		'''
+		Pickler that stores the numeric arrays and the large fitted vocabularies (the 
+		(str -> int) dicts under a (vocabulary_) attribute, e.g. of a vectorizer) as 
+		(.npy) files in (array_dir) instead of inside the pickle. A vocabulary is 
+		stored as its UTF-8 keys concatenated in one byte array, the offsets of the 
+		keys and their values. Any other dict is pickled as it is. 
+		''' 
+		super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL) 
+		self.array_dir = array_dir 
+		self.prefix = prefix 
+		self.min_size = min_size 
+		self.arrays = [] 
+		self._saved = dict() 
+		self._vocabularies = dict() 
+
+	def persistent_id(self, obj): 
+		# Reuse the file of an object referenced more than once. 
+		if id(obj) in self._saved: 
+			return self._saved[id(obj)] 
+
+		# Mark the fitted vocabulary of an object, which is pickled after the object itself. 
+		vocabulary = getattr(obj, "__dict__", {}).get("vocabulary_") if not isinstance(obj, type) else None 
+		if isinstance(vocabulary, dict) and len(vocabulary) >= self.min_size and _is_vocabulary(vocabulary): 
+			self._vocabularies[id(vocabulary)] = vocabulary 
+
+		if isinstance(obj, np.ndarray) and obj.dtype != object and obj.size >= self.min_size: 
+			pid = ("npy", self._save_array(obj)) 
+		elif id(obj) in self._vocabularies: 
+			pid = ("vocab", *(self._save_array(array) for array in _encode_vocabulary(obj))) 
+		else: 
+			return None 
+
+		self._saved[id(obj)] = pid 
+		return pid 
+
+	def _save_array(self, array:np.array) -> str: 
+		filename = f"{self.prefix}_{len(self.arrays)}.npy" 
+		np.save(os.path.join(self.array_dir, filename), np.ascontiguousarray(array), allow_pickle=False) 
+		self.arrays.append(filename) 
+		return filename 
+
+
+
+# %%
+class ArrayUnpickler(pickle.Unpickler): 
+	def __init__(self, file, array_dir:str, mmap:bool=True): 
+		'''
+		Unpickler loading the (.npy) files written by (ArrayPickler). If (mmap), the 
+		arrays are memory-mapped copy-on-write: the pages are shared until written, 
+		and the arrays stay writable for the libraries requiring it (e.g. thinc). 
+		''' 
+		super().__init__(file) 
+		self.array_dir = array_dir 
+		self.mmap_mode = "c" if mmap else None 
+
+	def persistent_load(self, pid): 
+		if pid[0] == "npy": 
+			return self._load_array(pid[1]) 
+		elif pid[0] == "vocab": 
+			return _decode_vocabulary(*(self._load_array(filename) for filename in pid[1:])) 
+		raise pickle.UnpicklingError(f"Unknown persistent ID ({pid[0]}).") 
+
+	def _load_array(self, filename:str) -> np.array: 
+		return np.load(os.path.join(self.array_dir, filename), mmap_mode=self.mmap_mode, allow_pickle=False) 
+
+
+
+# %%
+def _encode_vocabulary(vocabulary:dict) -> tuple: 
+	'''Encode the vocabulary as its UTF-8 keys concatenated in one byte array, their offsets and values.''' 
+
+	keys = [key.encode("utf8") for key in vocabulary.keys()] 
+	offsets = np.zeros(len(keys) + 1, dtype=np.int64) 
+	np.cumsum([len(key) for key in keys], out=offsets[1:]) 
+	data = np.frombuffer(b"".join(keys), dtype=np.uint8) 
+	values = np.fromiter(vocabulary.values(), dtype=np.int64, count=len(keys)) 
+	return data, offsets, values 
+
+
+def _decode_vocabulary(data:np.array, offsets:np.array, values:np.array) -> dict: 
+	'''Rebuild the vocabulary dict encoded by (_encode_vocabulary), in the same key order.''' 
+
+	raw, offsets = data.tobytes(), offsets.tolist() 
+	keys = [raw[beg:end].decode("utf8") for beg, end in zip(offsets[:-1], offsets[1:])] 
+	return dict(zip(keys, values.tolist())) 
+
+
+
+# %%
+def _is_vocabulary(obj:dict) -> bool: 
+	'''Check if the dict maps strings to integers, like a fitted vectorizer vocabulary.''' 
+
+	return all(isinstance(k, str) for k in obj.keys()) and all(isinstance(v, (int, np.integer)) for v in obj.values()) 
+
+
+
+# %%
+def _concat_tables(tables:list) -> pa.Table: 
+	'''Concatenate the tables, unifying their schemas (the keyword changed in pyarrow 14).'''
+
+	try: 
+		return pa.concat_tables(tables, promote_options="default") 
+	except TypeError: 
+		return pa.concat_tables(tables, promote=True) 
+
+
+def _hash_file(path:str) -> str: 
+	'''Hash the content of the file, for content-addressed file names.''' 
+
+	digest = hashlib.sha1() 
+	with open(path, "rb") as f: 
+		for block in iter(lambda: f.read(1 << 20), b""): 
+			digest.update(block) 
+	return digest.hexdigest()[:16] 
+
+
+def _hash_names(names:list) -> str: 
+	return hashlib.sha1("\n".join(names).encode("utf8")).hexdigest()[:16] 
+
+
+def _complete_compaction(root:str, marker:str): 
+	'''
+	Finish the compaction recorded by the (marker) in the partition (root): remove the 
+	replaced files if the merged file was published, otherwise drop the merged file 
+	being written. The marker is removed last. 
+	''' 
+
+	with open(os.path.join(root, marker), "r") as f: 
+		record = json.load(f) 
+
+	if os.path.exists(os.path.join(root, record["compacted"])): 
+		for part in record["parts"]: 
+			if os.path.exists(os.path.join(root, part)): 
+				os.remove(os.path.join(root, part)) 
+	else: 
+		tmppath = os.path.join(root, f".{record['compacted']}.tmp") 
+		if os.path.exists(tmppath): 
+			os.remove(tmppath) 
+	os.remove(os.path.join(root, marker)) 
+
+
+def _write_atomic(path:str, content:str): 
+	'''Write the file under a temporary name and rename it in place.''' 
+
+	tmppath = f"{path}.tmp-{uuid.uuid4().hex}" 
+	with open(tmppath, "w") as f: 
+		f.write(content) 
+		f.flush() 
+		os.fsync(f.fileno()) 
+	os.replace(tmppath, path) 
+
+
+
+# %%
+def date_filter(date_beg:str=None, date_end:str=None, column:str="date", partitioned:bool=False) -> list: 
+	'''
+	Build the (read_dataset) filters for an inclusive date range. Set (partitioned) 
+	for datasets written by (write_to_dataset) to also filter on the (year) 
+	partitions, so that the untouched partitions are skipped. 
+	''' 
+
+	filters = [] 
+	if date_beg is not None: 
+		filters.append((column, ">=", pd.Timestamp(date_beg))) 
+		if partitioned: 
+			filters.append(("year", ">=", pd.Timestamp(date_beg).year)) 
+	if date_end is not None: 
+		filters.append((column, "<=", pd.Timestamp(date_end))) 
+		if partitioned: 
+			filters.append(("year", "<=", pd.Timestamp(date_end).year)) 
+	return filters or None 
+
+
+
+# %%
+def to_spacy_document(nlp:spacy.language.Language, data, n_process:int=PARAM_SPACY_N_PROCESS, batch_size:int=PARAM_SPACY_BATCH_SIZE, keep_pipes:tuple=(), labels:tuple=SENTIMENT_LABELS): 
 	'''
-	Convert the TRAIN and TEST into SpaCy document. For more information on
-	how to enable and disable SpaCy pipeline check out the following links: 
+	Convert the TRAIN and TEST into SpaCy document. The (text, label) tuples can 
+	be any iterable and the docs are yielded as they come out of (nlp.pipe), so 
+	the dataset is never held in memory. Each doc takes its (cats) from a lookup 
+	table by label, the unknown labels count as the last label (neutral). For 
+	more information on how to enable and disable SpaCy pipeline check out the 
+	following links: 
 	- https://spacy.io/api/language#pipe 
 	- https://spacy.io/usage/processing-pipelines
 	- https://spacy.io/usage/processing-pipelines#disabling
 	'''
 	print("Reformatting the dataset...") 
 
-	# To store a list of (Spacy Doc) object. 
-	text = []
+	# One (cats) row per label, e.g. positive -> {positive: 1, negative: 0, neutral: 0}. 
+	cats_table = [dict(zip(labels, row)) for row in np.eye(len(labels), dtype=int).tolist()] 
+
+	# Map the labels to their index, the unknown ones to the last label. 
+	label_index = {label: i for i, label in enumerate(labels)} 
+	data = ((text, label_index.get(label, len(labels) - 1)) for text, label in data) 
 
 	# Use SpaCy Doc object to categorise the sentiment. 
-	for doc, label in nlp.pipe(data, as_tuples=True): 
-		if label =="positive":
-			doc.cats["positive"] = 1
-			doc.cats["negative"] = 0
-			doc.cats["neutral"]  = 0
-		elif label == "negative":
-			doc.cats["positive"] = 0
-			doc.cats["negative"] = 1
-			doc.cats["neutral"]  = 0
-		else:
-			doc.cats["positive"] = 0
-			doc.cats["negative"] = 0
-			doc.cats["neutral"]  = 1
-		text.append(doc) 
+	disable = [pipe for pipe in nlp.pipe_names if pipe not in keep_pipes] 
+	docs = nlp.pipe(data, as_tuples=True, n_process=n_process, batch_size=batch_size, disable=disable) 
+	for doc, code in docs: 
+		doc.cats = dict(cats_table[code]) 
+		yield doc 
 
 	print("Reformatted the dataset.") 
-
-	return text 
@@ -0,0 +1,133 @@
+# %%
+# Python modules.
+import os, sys, threading, subprocess
+
+# Custom configs.
+from source.config_py.config import DIR_MLSPACY, DIR_MLTOPIC, DIR_MLESTIM, IMPORT_TIME_BUDGET
+
+
+
+# %%
+class ModelRegistry():
+    def __init__(self):
+        '''
+        Registry of the models loaded lazily. Each model is loaded by its loader on
+        the first (get) and kept for the rest of the process. The loading is
+        thread-safe and happens once per process even with concurrent callers.
+        '''
+        self._loaders = dict()
+        self._models = dict()
+        self._locks = dict()
+        self._lock = threading.Lock()
+
+    def register(self, name:str, loader):
+        '''Register the function that loads the model.'''
+
+        with self._lock:
+            self._loaders[name] = loader
+            self._locks[name] = threading.Lock()
+            self._models.pop(name, None)
+
+    def get(self, name:str):
+        '''Get the model, loading it on the first call.'''
+
+        if name in self._models:
+            return self._models[name]
+
+        if name not in self._loaders:
+            raise KeyError(f"No model registered under ({name}).")
+
+        # Only one thread loads the model, the others wait for it.
+        with self._locks[name]:
+            if name not in self._models:
+                print(f"Load model ({name}).")
+                self._models[name] = self._loaders[name]()
+        return self._models[name]
+
+    def is_loaded(self, name:str) -> bool:
+        return name in self._models
+
+    def unload(self, name:str):
+        '''Drop the loaded model so the next (get) loads it again.'''
+
+        self._models.pop(name, None)
+
+
+
+# %%
+def _load_spacy_pipeline():
+    import spacy
+    return spacy.load(f"{DIR_MLSPACY}/model-best")
+
+
+def _load_spacy_tokenizer():
+    from spacy.tokenizer import Tokenizer
+    return Tokenizer(registry.get("mlpipe_spacy").vocab)
+
+
+def _load_versioned(dir:str, obj_name:str):
+    '''Load the latest version from the artifact store, or the versioned pickle if none.'''
+
+    from source.modules.manage_files import ManageFiles
+
+    manage_files = ManageFiles()
+    if manage_files.list_artifact_versions(dir, obj_name):
+        return manage_files.load_artifact(dir, obj_name, version_load="latest")
+    try:
+        return manage_files.load_version_pk(dir, obj_name, version_load="latest")
+    except Exception as err:
+        raise FileNotFoundError(
+            f"No version of ({obj_name}) in ({dir}). The scoring models are published by "
+            f"(processor_estim.publish_best_model), see (sh/cli_exec.sh)."
+        ) from err
+
+
+def _load_experiment_model():
+    from source.config_py import config
+    return config.EXPERIMENT_MODEL
+
+
+
+# %%
+# The models shared by the modules and workers of a process.
+registry = ModelRegistry()
+registry.register("mlpipe_spacy", _load_spacy_pipeline)
+registry.register("tokenz_spacy", _load_spacy_tokenizer)
+registry.register("mlpipe_topic", lambda: _load_versioned(DIR_MLTOPIC, "mlpipe_topic"))
+registry.register("mlpipe_estim", lambda: _load_versioned(DIR_MLESTIM, "mlpipe_estim"))
+registry.register("best_estimator", lambda: _load_versioned(DIR_MLESTIM, "best_estimator"))
+registry.register("experiment_model", _load_experiment_model)
+
+
+def get_model(name:str):
+    '''Get the model from the process-wide registry, loading it on first use.'''
+
+    return registry.get(name)
+
+
+
+# %%
+def benchmark_imports(budget:dict=IMPORT_TIME_BUDGET, n_runs:int=3) -> dict:
+    '''
+    Measure the import time of each module in a fresh interpreter and compare it
+    against the budget. Returns the best time out of (n_runs) per module.
+    '''
+    timings = dict()
+    for module in budget:
+        code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+        runs = [
+            float(subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd=os.getcwd()).stdout)
+            for _ in range(n_runs)
+        ]
+        timings[module] = min(runs)
+        status = "OK" if timings[module] <= budget[module] else "OVER BUDGET"
+        print(f"{module:40s} {timings[module]:.3f}s (budget {budget[module]:.3f}s) {status}")
+    return timings
+
+
+
+# %%
+if __name__ == "__main__":
+    # Fail when any module exceeds its import time budget.
+    timings = benchmark_imports()
+    sys.exit(int(any(timings[module] > IMPORT_TIME_BUDGET[module] for module in timings)))
@@ -1,21 +1,31 @@
 # %% 
 # Python modules. 
+import os, ast 
 import numpy as np 
 import pandas as pd 
 import scipy 
-import optuna 
-from sklearn.base import BaseEstimator, TransformerMixin 
+from sklearn.base import BaseEstimator, TransformerMixin, clone, is_classifier 
 from sklearn.utils.validation import check_is_fitted 
 from feature_engine.encoding import OneHotEncoder 
-from sklearn.model_selection import GridSearchCV 
+from sklearn.model_selection import GridSearchCV, check_cv 
+from sklearn.metrics import check_scoring 
+from sklearn.utils import _safe_indexing 
 from sklearn.pipeline import Pipeline 
+from joblib import Parallel, delayed, cpu_count, effective_n_jobs, hash as joblib_hash 
 from feature_engine.variable_manipulation import _check_input_parameter_variables 
 
 # For clearing safe warnings. Not important. 
 from IPython.display import clear_output 
 
-# Custom configs. 
-from source.config_py.config import PARAM_SEED, EXPERIMENT_COMPS, EXPERIMENT_MODEL 
+# Custom modules. 
+from source.modules.manage_files import ManageFiles 
+
+# Custom configs. The estimators in (config.EXPERIMENT_MODEL) are built on first access. 
+from source.config_py import config 
+from source.config_py.config import (
+    DIR_MLESTIM, PARAM_SEED, PARAM_SPACY_BATCH_SIZE, PARAM_SPACY_N_PROCESS, PARAM_SPACY_KEEP_PIPES, 
+    EXPERIMENT_COMPS, EXPERIMENT_STORAGE_PARALLEL, EXPERIMENT_PRUNER, EXPERIMENT_PRUNE_WARMUP 
+)
 
 
 
@@ -60,10 +70,14 @@ class ToSparse(BaseEstimator, TransformerMixin):
 
 # %%
 class ExtractSentiment(BaseEstimator, TransformerMixin):
-    def __init__(self, est_pipe, var_proc, var_name="sentiment"): 
+    def __init__(self, est_pipe, var_proc, var_name="sentiment", batch_size=None, n_process=PARAM_SPACY_N_PROCESS, keep_pipes=PARAM_SPACY_KEEP_PIPES, cache=None): 
         self.est_pipe = est_pipe 
         self.var_proc = var_proc 
         self.var_name = var_name 
+        self.batch_size = batch_size 
+        self.n_process = n_process 
+        self.keep_pipes = keep_pipes 
+        self.cache = cache 
         self.feature_names_in_ = [] 
         self.feature_names_out = [] 
 
@@ -73,19 +87,52 @@ class ExtractSentiment(BaseEstimator, TransformerMixin):
         return self
 
     def transform(self, X): 
-        # Extract sentiment. 
-        X[self.var_name] = X[self.var_proc].apply(self._find_max) 
+        # Extract sentiment. Only the texts missing from the cache are scored 
+        # when a cache is given. 
+        if self.cache is not None: 
+            X[self.var_name] = self.cache.lookup_or_compute(X[self.var_proc], self._extract, namespace=self.var_name) 
+        else: 
+            X[self.var_name] = self._extract(X[self.var_proc]) 
         X = X.drop(columns=[self.var_proc]) 
 
         # Track the output columns or features. 
         self.feature_names_out = X.columns.to_list() 
         return X 
 
+    def _extract(self, texts:pd.Series) -> np.array: 
+        # Stream the whole column through (nlp.pipe) when the batched mode 
+        # is enabled, otherwise score one row at a time. 
+        if self.batch_size: 
+            return self._find_max_batch(texts) 
+        return texts.apply(self._find_max).to_numpy() 
+
     def _find_max(self, row): 
         dic_score = self.est_pipe(row).cats 
         sentiment = max(dic_score, key=dic_score.get) 
         return sentiment 
 
+    def _find_max_batch(self, texts:pd.Series) -> np.array: 
+        '''
+        Score the texts in batches and take the argmax label for each of them. 
+        Pipes the textcat does not need are disabled while streaming. 
+        '''
+        disable = [pipe for pipe in self.est_pipe.pipe_names if pipe not in self.keep_pipes] 
+        docs = self.est_pipe.pipe(
+            texts.astype(str), batch_size=self.batch_size, n_process=self.n_process, disable=disable 
+        ) 
+
+        # Collect the category scores into a (text x label) matrix. 
+        labels, scores = [], np.empty((len(texts), 0), dtype=np.float32) 
+        for i, doc in enumerate(docs): 
+            if i == 0: 
+                labels = list(doc.cats) 
+                scores = np.empty((len(texts), len(labels)), dtype=np.float32) 
+            scores[i] = [doc.cats[label] for label in labels] 
+
+        if not labels: 
+            return np.array([], dtype=object) 
+        return np.array(labels, dtype=object)[scores.argmax(axis=1)] 
+
     def get_feature_names_out(self) -> list: 
         # Check if the transformer has fitted or not before user can extract the output features. 
         check_is_fitted(self) 
@@ -99,10 +146,11 @@ class ExtractSentiment(BaseEstimator, TransformerMixin):
 
 # %%
 class ExtractTopic(BaseEstimator, TransformerMixin):
-    def __init__(self, est_pipe, var_proc, var_name="theme"): 
+    def __init__(self, est_pipe, var_proc, var_name="theme", cache=None): 
         self.est_pipe = est_pipe 
         self.var_proc = var_proc 
         self.var_name = var_name 
+        self.cache = cache 
         self.feature_names_in_ = [] 
         self.feature_names_out = [] 
 
@@ -112,10 +160,13 @@ class ExtractTopic(BaseEstimator, TransformerMixin):
         return self
 
     def transform(self, X): 
-        # Extract topic. 
+        # Extract topic. Only the entity lists missing from the cache are 
+        # transformed when a cache is given. 
         X[self.var_proc] = X[self.var_proc].astype("object") 
-        X[self.var_name] = np.argmax(self.est_pipe.transform(X[self.var_proc]), axis=1) 
-        X[self.var_name] = "topic_" + X[self.var_name].astype(str) 
+        if self.cache is not None: 
+            X[self.var_name] = self.cache.lookup_or_compute(X[self.var_proc], self._extract, namespace=self.var_name) 
+        else: 
+            X[self.var_name] = self._extract(X[self.var_proc]) 
 
         # Remove the original column or feature. We only keep the processed feature. 
         X = X.drop(columns=[self.var_proc]) 
@@ -124,6 +175,10 @@ class ExtractTopic(BaseEstimator, TransformerMixin):
         self.feature_names_out = X.columns.to_list() 
         return X 
 
+    def _extract(self, entities:pd.Series) -> np.array: 
+        topics = np.argmax(self.est_pipe.transform(entities), axis=1) 
+        return np.char.add("topic_", topics.astype(str)).astype(object) 
+
     def get_feature_names_out(self) -> list: 
         # Check if the transformer has fitted or not before user can extract the output features. 
         check_is_fitted(self) 
@@ -136,15 +191,198 @@ class ExtractTopic(BaseEstimator, TransformerMixin):
 
 
 # %% 
-def search_opt(estimator, X, y, param_dist:dict, bayes:bool=True, n_trials:int=50, scoring:str="neg_root_mean_squared_error", verbose:int=2): 
+class PrunedSearchCV(BaseEstimator): 
+    def __init__(self, estimator, param_distributions:dict, study, cv:int=10, n_trials:int=50, scoring:str="neg_root_mean_squared_error", timeout:int=600, verbose:int=2): 
+        '''
+        Bayesian search that evaluates each trial fold by fold and reports the running 
+        mean score to the study after every fold, so that the study pruner can stop 
+        a trial early. Exposes the same (study_) and (best_estimator_) attributes 
+        as (OptunaSearchCV). 
+        '''
+        self.estimator = estimator 
+        self.param_distributions = param_distributions 
+        self.study = study 
+        self.cv = cv 
+        self.n_trials = n_trials 
+        self.scoring = scoring 
+        self.timeout = timeout 
+        self.verbose = verbose 
+
+    def fit(self, X, y): 
+        import optuna 
+
+        cv = check_cv(self.cv, y, classifier=is_classifier(self.estimator)) 
+        scorer = check_scoring(self.estimator, scoring=self.scoring) 
+        folds = list(cv.split(X, y)) 
+
+        def objective(trial): 
+            params = {name: suggest_from(trial, name, dist) for name, dist in self.param_distributions.items()} 
+
+            scores = [] 
+            for step, (index_train, index_test) in enumerate(folds): 
+                estimator = clone(self.estimator).set_params(**params) 
+                estimator.fit(_safe_indexing(X, index_train), _safe_indexing(y, index_train)) 
+                scores.append(scorer(estimator, _safe_indexing(X, index_test), _safe_indexing(y, index_test))) 
+
+                # Track the score so far and let the pruner decide. 
+                trial.set_user_attr("mean_test_score", float(np.mean(scores))) 
+                trial.set_user_attr("std_test_score", float(np.std(scores))) 
+                trial.report(float(np.mean(scores)), step) 
+                if trial.should_prune(): 
+                    raise optuna.TrialPruned() 
+
+            return float(np.mean(scores)) 
+
+        if not self.verbose: 
+            optuna.logging.set_verbosity(optuna.logging.WARNING) 
+        self.study.optimize(objective, n_trials=self.n_trials, timeout=self.timeout) 
+
+        # Refit the best parameters on the whole dataset. 
+        self.study_ = self.study 
+        self.best_params_ = self.study_.best_trial.params 
+        self.best_score_ = self.study_.best_trial.value 
+        self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_).fit(X, y) 
+        return self 
+
+    def predict(self, X): 
+        return self.best_estimator_.predict(X) 
+
+
+
+# %% 
+def suggest_from(trial, name:str, dist): 
+    '''
+    Suggest a value for the optuna distribution (dist) through the public (suggest_*) 
+    methods. Handles the distributions of optuna 2.x (e.g. IntUniformDistribution, 
+    LogUniformDistribution) and the (IntDistribution, FloatDistribution) of optuna 3+. 
+    '''
+    import optuna 
+
+    dists = optuna.distributions 
+    int_types = tuple(getattr(dists, t) for t in ["IntDistribution", "IntUniformDistribution", "IntLogUniformDistribution"] if hasattr(dists, t)) 
+    log_types = tuple(getattr(dists, t) for t in ["LogUniformDistribution", "IntLogUniformDistribution"] if hasattr(dists, t)) 
+
+    if isinstance(dist, dists.CategoricalDistribution): 
+        return trial.suggest_categorical(name, dist.choices) 
+
+    log = getattr(dist, "log", isinstance(dist, log_types)) 
+    step = getattr(dist, "step", getattr(dist, "q", None)) 
+    if isinstance(dist, int_types): 
+        return trial.suggest_int(name, dist.low, dist.high, step=step or 1, log=log) 
+    return trial.suggest_float(name, dist.low, dist.high, step=step, log=log) 
+
+
+
+# %% 
+def get_fingerprint(X, y, param_dist:dict, cv:int) -> str: 
+    '''Short hash of the search inputs, so that a stored study is only resumed on the same data.''' 
+
+    return joblib_hash((X, y, repr(sorted(param_dist.items())), cv))[:12] 
+
+
+
+# %% 
+def get_study(study_name:str=None, storage:str=None, pruner:str=None): 
+    '''
+    Create a study or resume the existing one with the same name from the storage. 
+    The (storage) can be a database URL or "journal:///path/to/file.log" for a 
+    journal file safe to share between processes. The (pruner) can be "median" 
+    or "halving". 
+    '''
+    import optuna 
+
+    # Ensure the directory of the SQLite or journal file exists. 
+    for scheme in ["sqlite:///", "journal:///"]: 
+        if isinstance(storage, str) and storage.startswith(scheme): 
+            os.makedirs(os.path.dirname(storage[len(scheme):]) or ".", exist_ok=True) 
+    if isinstance(storage, str) and storage.startswith("journal:///"): 
+        storage = get_journal_storage(storage[len("journal:///"):]) 
+
+    if pruner == "median": 
+        pruner = optuna.pruners.MedianPruner(n_startup_trials=5, n_warmup_steps=EXPERIMENT_PRUNE_WARMUP) 
+    elif pruner == "halving": 
+        pruner = optuna.pruners.SuccessiveHalvingPruner(min_resource=EXPERIMENT_PRUNE_WARMUP) 
+    elif pruner is None: 
+        pruner = optuna.pruners.NopPruner() 
+
+    study = optuna.create_study(
+        study_name=study_name, storage=storage, direction="maximize", load_if_exists=True, 
+        sampler=optuna.samplers.TPESampler(seed=PARAM_SEED), pruner=pruner, 
+    ) 
+    return study 
+
+
+
+# %% 
+def get_journal_backend(): 
+    '''Get the journal file backend class of optuna, None before optuna 3.1.''' 
+    import optuna 
+
+    # The file backend was renamed in optuna 4.0 and added in optuna 3.1. 
+    try: 
+        from optuna.storages.journal import JournalFileBackend 
+    except ImportError: 
+        JournalFileBackend = getattr(optuna.storages, "JournalFileStorage", None) 
+    return JournalFileBackend 
+
+
+def get_journal_storage(path:str): 
+    '''Optuna storage appending the trials to the journal file at (path), with file locks.''' 
+    import optuna 
+
+    JournalFileBackend = get_journal_backend() 
+    if JournalFileBackend is None: 
+        raise ValueError(
+            f"The journal storage needs optuna >= 3.1 (found {optuna.__version__}). " 
+            f"Run the multiverse analysis with (n_jobs=1) or without (storage)." 
+        ) 
+
+    return optuna.storages.JournalStorage(JournalFileBackend(path)) 
+
+
+
+# %% 
+def search_opt(estimator, X, y, param_dist:dict, bayes:bool=True, n_trials:int=50, scoring:str="neg_root_mean_squared_error", verbose:int=2, storage:str=None, study_name:str=None, pruner:str=None): 
     '''
     For hyperparameter tuning. Check out the following for guidance: 
     Bayesian: 
         - https://github.com/optuna/optuna-examples/blob/main/sklearn/sklearn_optuna_search_cv_simple.py 
         - https://www.section.io/engineering-education/optimizing-ml-models-with-optuna/ 
+        - https://optuna.readthedocs.io/en/stable/tutorial/20_recipes/001_rdb.html 
+
+    Give a (storage) such as "sqlite:///path/to/file.db" and a (study_name) to keep 
+    the trials on disk. Rerunning with the same name resumes the study and only 
+    runs the trials still missing out of (n_trials). The name is suffixed with a 
+    fingerprint of (X, y, param_dist, cv), so new data or search space starts a new 
+    study. Give a (pruner) ("median" or "halving") to stop a trial early once its 
+    first folds are clearly worse. 
     ''' 
+    import optuna 
+    from optuna.trial import TrialState 
+
     # Setup the optimizer. 
-    if bayes: 
+    if bayes and (storage or pruner): 
+        if storage and study_name: 
+            study_name = f"{study_name}_{get_fingerprint(X, y, param_dist, 10)}" 
+        study = get_study(study_name=study_name, storage=storage, pruner=pruner) 
+
+        # Only run the trials missing from the resumed study. 
+        n_done = len([t for t in study.trials if t.state in (TrialState.COMPLETE, TrialState.PRUNED)]) 
+        n_trials = max(0, n_trials - n_done) 
+        print(f"Study ({study_name}): resumed ({n_done}) trials, running ({n_trials}) more.") 
+
+        if pruner: 
+            search_cv = PrunedSearchCV(
+                estimator, param_dist, study, cv=10, n_trials=n_trials, 
+                scoring=scoring, timeout=600, verbose=verbose, 
+            ) 
+        else: 
+            search_cv = optuna.integration.OptunaSearchCV(
+                estimator, param_dist, cv=10, n_trials=n_trials, 
+                scoring=scoring, refit=True, timeout=600, verbose=verbose, 
+                error_score="raise", study=study, 
+            ) 
+    elif bayes: 
         search_cv = optuna.integration.OptunaSearchCV(
             estimator, param_dist, cv=10, n_trials=n_trials, 
             scoring=scoring, refit=True, timeout=600, verbose=verbose, 
@@ -175,70 +413,289 @@ def search_opt(estimator, X, y, param_dist:dict, bayes:bool=True, n_trials:int=5
 
 
 # %% 
-def multiverse_analysis(X, y, n_trials:int=50, verbose:int=2, **kwargs) -> pd.DataFrame: 
+def get_component_vars(component:str) -> list: 
+    '''Get the input columns needed to build specific multiverse component.''' 
+
+    if component == "newstheme": 
+        return ["theme_sub"] 
+    elif component == "sentiment": 
+        return ["headline"] 
+    elif component == "autocorrs": 
+        return [f"spy_tscore_c2c_lag_{lag}" for lag in range(1,4,1)] 
+    raise ValueError(f"Unknown component ({component}).") 
+
+
+
+# %% 
+def build_feature_store(X, components:list=None, **kwargs) -> dict: 
+    '''
+    Materialize each multiverse component once as a feature block that is already 
+    one-hot encoded, so that every combination of components can be assembled 
+    via (compose_features) without extracting the features again. 
+    '''
+
+    # Only build the components used by the experiments. 
+    if components is None: 
+        components = list(dict.fromkeys(c for comps in EXPERIMENT_COMPS for c in comps)) 
+
+    feature_store = dict() 
+    for component in components: 
+        var_proc, pipeline = get_component_vars(component), [] 
+
+        if component == "newstheme": 
+            pipeline.append(("extract_newstheme", ExtractTopic(kwargs["mlpipe_topic"], var_proc="theme_sub", var_name="theme", cache=kwargs.get("cache_topic")))) 
+            pipeline.append(("oh_encoder", OneHotEncoder(drop_last=True, variables=["theme"]))) 
+        elif component == "sentiment": 
+            pipeline.append(("extract_sentiment", ExtractSentiment(kwargs["mlpipe_spacy"], var_proc="headline", var_name="sentiment", batch_size=PARAM_SPACY_BATCH_SIZE, cache=kwargs.get("cache_spacy")))) 
+            pipeline.append(("oh_encoder", OneHotEncoder(drop_last=True, variables=["sentiment"]))) 
+
+        # Construct the pipeline and extract the features once. 
+        mlpipe_estim = Pipeline([("select_col", ColumnSelector(var_proc=var_proc))] + pipeline) 
+        feature_store[component] = mlpipe_estim.fit_transform(X) 
+
+    # Clear safe warnings. Not important. 
+    clear_output() 
+
+    return feature_store 
+
+
+
+# %% 
+def compose_features(feature_store:dict, components:list, ordered:bool=False) -> pd.DataFrame: 
+    '''
+    Assemble the feature matrix for a combination of components by column 
+    concatenation. The (autocorrs) block comes first and the one-hot encoded 
+    blocks follow in the component order, the same column layout produced 
+    by running the components in a single pipeline. Set (ordered) to keep the 
+    (components) as given, e.g. a layout from (get_block_layout). 
+    '''
+
+    components = components if ordered else _order_components(components) 
+    return pd.concat([feature_store[c] for c in components], axis="columns") 
+
+
+
+# %% 
+def get_block_layout(combinations:list) -> list: 
+    '''
+    Order the component blocks so that every combination (a list of blocks in 
+    column order) is a contiguous run, e.g. [autocorrs, newstheme, sentiment, 
+    autocorrs, sentiment]. A block is repeated when no single order fits every 
+    combination. 
+    '''
+    layout = [] 
+    for blocks in sorted(combinations, key=len, reverse=True): 
+        if _find_blocks(layout, blocks) is None: 
+            layout.extend(blocks) 
+    return layout 
+
+
+def _find_blocks(layout:list, blocks:list) -> int: 
+    '''Position of the run of (blocks) in the (layout), None if missing.''' 
+
+    for beg in range(len(layout) - len(blocks) + 1): 
+        if layout[beg:beg + len(blocks)] == list(blocks): 
+            return beg 
+    return None 
+
+
+
+# %% 
+def _order_components(components:list) -> list: 
+    '''Put the (autocorrs) block first and keep the order of the rest.''' 
+
+    return [c for c in components if c == "autocorrs"] + [c for c in components if c != "autocorrs"] 
+
+
+
+# %% 
+def search_component(mlname:str, dict_mlparam:dict, components:list, X_values:np.array, col_slice:slice, col_names:list, y:np.array, n_trials:int=50, verbose:int=2, n_jobs_inner:int=None, storage:str=None, pruner:str=None) -> pd.DataFrame: 
+    '''
+    Run the hyperparameter search for one (model, components) combination and 
+    return its performance record. The (X_values) holds every composed feature 
+    column and may be a read-only memory-mapped array shared between workers. 
+    The combination takes the (col_slice) columns, a view rather than a copy. 
+    '''
+
+    colnames = ["est_names", "estimator", "component", "rmse_avg", "rmse_std"]
+
+    # Select the columns of this combination from the shared feature matrix. 
+    X_transformed = pd.DataFrame(X_values[:, col_slice], columns=col_names, copy=False) 
+    var_proc = [var for component in components for var in get_component_vars(component)] 
+
+    # Split the cores between the outer workers and the estimator threads. 
+    estimator = clone(dict_mlparam["model"]) 
+    if n_jobs_inner and "n_jobs" in estimator.get_params(): 
+        estimator.set_params(n_jobs=n_jobs_inner) 
+
+    # Hyperparameter optimisation. 
+    searchres = search_opt(
+        estimator, X_transformed, y, dict_mlparam["param_dist"], 
+        bayes=dict_mlparam["bayes_opt"], n_trials=n_trials, verbose=verbose, 
+        storage=storage, study_name=f"{mlname}_{'_'.join(components)}", pruner=pruner, 
+    ) 
+
+    # Track the performance for various combination of components and model choice. 
+    df_searchres = pd.DataFrame(columns=colnames) 
+    df_searchres["est_names"] = [mlname] 
+    df_searchres["estimator"] = [searchres.best_estimator_] 
+    df_searchres["component"] = [str(components)] 
+    df_searchres["ml_n_comp"] = [mlname + " + " + str(components)] 
+    df_searchres["feat_name"] = [var_proc] 
+    df_searchres["feat_out"] = [col_names] 
+    if dict_mlparam["bayes_opt"]: 
+        df_searchres["rmse_avg"] = [searchres.study_.best_trial.user_attrs["mean_test_score"]] 
+        df_searchres["rmse_std"] = [searchres.study_.best_trial.user_attrs["std_test_score"]] 
+    else: 
+        df_searchres["rmse_avg"] = [searchres.cv_results_["mean_test_score"][searchres.best_index_]] 
+        df_searchres["rmse_std"] = [searchres.cv_results_["std_test_score"][searchres.best_index_]] 
+
+    return df_searchres 
+
+
+
+# %% 
+def multiverse_analysis(X, y, n_trials:int=50, verbose:int=2, n_jobs:int=1, storage:str=None, pruner:str=EXPERIMENT_PRUNER, **kwargs) -> pd.DataFrame: 
     '''
     To perform multiverse analysis for various combination of components and models. 
+    Pass (cache_spacy) and (cache_topic) as (ManageCache) objects in kwargs to reuse 
+    the extracted sentiment and topics across runs. Pass a prebuilt (feature_store) 
+    to skip the feature extraction entirely. 
+
+    Set (n_jobs) above 1 to run the combinations in a process pool. The feature 
+    matrix is memory-mapped into the workers instead of being copied, and the 
+    remaining cores are given to the estimator threads of each worker. 
+
+    The trials are pruned early by (pruner), set it to None to run the plain search. 
+    Give a (storage) (e.g. config.EXPERIMENT_STORAGE) to keep one named study per 
+    (model, components, data) on disk and resume it on rerun. See (search_opt). 
+    With (n_jobs) above 1, a SQLite (storage) is replaced by 
+    (config.EXPERIMENT_STORAGE_PARALLEL), since the processes would lock each 
+    other out of the SQLite file. Before optuna 3.1, which has no journal 
+    storage, the parallel run keeps its studies in memory. 
     '''
 
     colnames = ["est_names", "estimator", "component", "rmse_avg", "rmse_std"]
 
-    # To track the model performance for each combination of features and models. 
-    df_performances = pd.DataFrame(columns=colnames) 
+    # Extract each component once. The combinations are assembled from these blocks. 
+    feature_store = kwargs.get("feature_store") 
+    if feature_store is None: 
+        feature_store = build_feature_store(X, **kwargs) 
 
-    # Explore the same set of componenets for each model choice. 
-    for mlname, dict_mlparam in EXPERIMENT_MODEL.items(): 
+    # Compose every component into a single numeric matrix, laid out so that each 
+    # combination is a contiguous range of columns. Stored column-major, the range 
+    # is a contiguous view of the matrix (also when memory-mapped) and not a copy. 
+    layout = get_block_layout([_order_components(components) for components in EXPERIMENT_COMPS]) 
+    X_values = np.asfortranarray(compose_features(feature_store, layout, ordered=True).to_numpy(dtype=np.float64)) 
+    y_values = np.asarray(y) 
 
-        # Experiment model training using different set of components. 
-        for components in EXPERIMENT_COMPS: 
-            pipeline, var_proc, ohencode = [], [], [] 
-
-            # Add the defined component to the pipeline. In the future, we can map the 
-            # component name to the function using dictionary to dynamically obtain 
-            # the function for specific component instead of hard code them this way. 
-            for component in components: 
-                if component == "newstheme": 
-                    var_proc.extend(["theme_sub"]) 
-                    pipeline.append(("extract_newstheme", ExtractTopic(kwargs["mlpipe_topic"], var_proc="theme_sub", var_name="theme"))) 
-                    ohencode.append("theme") 
-                elif component == "sentiment": 
-                    var_proc.extend(["headline"]) 
-                    pipeline.append(("extract_sentiment", ExtractSentiment(kwargs["mlpipe_spacy"], var_proc="headline", var_name="sentiment"))) 
-                    ohencode.append("sentiment") 
-                elif component == "autocorrs": 
-                    var_proc.extend([f"spy_tscore_c2c_lag_{lag}" for lag in range(1,4,1)]) 
-
-            # Transform categorical variable into OHE if any. 
-            if ohencode: 
-                pipeline.append(("oh_encoder", OneHotEncoder(drop_last=True, variables=ohencode))) 
-        
-            # Construct the pipeline. 
-            mlpipe_estim = Pipeline([("select_col", ColumnSelector(var_proc=var_proc))] + pipeline) 
-            X_transformed = mlpipe_estim.fit_transform(X) 
-
-            # Hyperparameter optimisation. 
-            searchres = search_opt(
-                dict_mlparam["model"], X_transformed, y, dict_mlparam["param_dist"], 
-                bayes=dict_mlparam["bayes_opt"], n_trials=n_trials, verbose=verbose
-            ) 
+    # Column position of each block in the layout. 
+    block_beg = np.cumsum([0] + [feature_store[block].shape[1] for block in layout]).tolist() 
 
-            # Track the performance for various combination of components and model choice. 
-            df_searchres = pd.DataFrame(columns=colnames) 
-            df_searchres["est_names"] = [mlname] 
-            df_searchres["estimator"] = [searchres.best_estimator_] 
-            df_searchres["component"] = [str(components)] 
-            df_searchres["ml_n_comp"] = [mlname + " + " + str(components)] 
-            df_searchres["feat_name"] = [var_proc] 
-            if dict_mlparam["bayes_opt"]: 
-                df_searchres["rmse_avg"] = [searchres.study_.best_trial.user_attrs["mean_test_score"]] 
-                df_searchres["rmse_std"] = [searchres.study_.best_trial.user_attrs["std_test_score"]] 
-            else: 
-                df_searchres["rmse_avg"] = [searchres.cv_results_["mean_test_score"][searchres.best_index_]] 
-                df_searchres["rmse_std"] = [searchres.cv_results_["std_test_score"][searchres.best_index_]] 
+    # Explore the same set of componenets for each model choice. 
+    tasks = [] 
+    for mlname, dict_mlparam in config.EXPERIMENT_MODEL.items(): 
+        for components in EXPERIMENT_COMPS: 
+            blocks = _order_components(components) 
+            beg = _find_blocks(layout, blocks) 
+            col_slice = slice(block_beg[beg], block_beg[beg + len(blocks)]) 
+            col_names = [c for comp in blocks for c in feature_store[comp].columns] 
+            tasks.append((mlname, dict_mlparam, components, col_slice, col_names)) 
 
-            # Consolidate the performance result. 
-            df_performances = pd.concat([df_performances, df_searchres], axis="index") 
+    if n_jobs == 1: 
+        results = [] 
+        for mlname, dict_mlparam, components, col_slice, col_names in tasks: 
+            results.append(search_component(mlname, dict_mlparam, components, X_values, col_slice, col_names, y_values, n_trials, verbose, None, storage, pruner)) 
 
             # Clear safe warnings. Not important. 
             clear_output() 
+    else: 
+        # The workers share a journal file instead of the SQLite file. 
+        if isinstance(storage, str) and storage.startswith("sqlite:///"): 
+            if get_journal_backend() is None: 
+                print(f"Parallel run: the journal storage needs optuna >= 3.1, keeping the studies in memory instead of ({storage}).") 
+                storage = None 
+            else: 
+                print(f"Parallel run: storing the studies in ({EXPERIMENT_STORAGE_PARALLEL}) instead of ({storage}).") 
+                storage = EXPERIMENT_STORAGE_PARALLEL 
+
+        # Balance the outer workers and the estimator threads. 
+        n_jobs = effective_n_jobs(n_jobs) 
+        n_jobs_inner = max(1, cpu_count() // n_jobs) 
+
+        # Arrays above (max_nbytes) are dumped once and memory-mapped read-only in the workers. 
+        results = Parallel(n_jobs=n_jobs, backend="loky", max_nbytes="1M", mmap_mode="r")(
+            delayed(search_component)(mlname, dict_mlparam, components, X_values, col_slice, col_names, y_values, n_trials, verbose, n_jobs_inner, storage, pruner) 
+            for mlname, dict_mlparam, components, col_slice, col_names in tasks 
+        ) 
+
+    # Consolidate the performance result. 
+    df_performances = pd.concat([pd.DataFrame(columns=colnames)] + results, axis="index") 
 
     return df_performances 
+
+
+
+# %% 
+def build_estim_pipeline(components:list, feature_names:list=None, **kwargs) -> Pipeline: 
+    '''
+    Build the feature pipeline of a combination of components, the single-pipeline 
+    equivalent of the blocks assembled by (compose_features). Pass the 
+    (feature_names) the estimator was trained on to select and order the output 
+    columns the same way. Expects (mlpipe_topic) and (mlpipe_spacy) in kwargs for 
+    the (newstheme) and (sentiment) components. 
+    '''
+
+    components = _order_components(components) 
+    var_proc = [var for component in components for var in get_component_vars(component)] 
+    pipeline, variables = [("select_col", ColumnSelector(var_proc=var_proc))], [] 
+
+    if "newstheme" in components: 
+        pipeline.append(("extract_newstheme", ExtractTopic(kwargs["mlpipe_topic"], var_proc="theme_sub", var_name="theme"))) 
+        variables.append("theme") 
+    if "sentiment" in components: 
+        pipeline.append(("extract_sentiment", ExtractSentiment(kwargs["mlpipe_spacy"], var_proc="headline", var_name="sentiment", batch_size=PARAM_SPACY_BATCH_SIZE))) 
+        variables.append("sentiment") 
+    if variables: 
+        pipeline.append(("oh_encoder", OneHotEncoder(drop_last=True, variables=variables))) 
+    if feature_names is not None: 
+        pipeline.append(("select_feat", ColumnSelector(var_proc=list(feature_names)))) 
+
+    return Pipeline(pipeline) 
+
+
+
+# %% 
+def publish_best_model(df_performances:pd.DataFrame, X, index=None, dir:str=DIR_MLESTIM, dev_status:bool=True, **kwargs) -> dict: 
+    '''
+    Publish the models used by the scoring service. The feature pipeline of the 
+    chosen (df_performances) row is fitted on (X) (the training set of the 
+    multiverse analysis) and saved as (mlpipe_estim), and the row's estimator as 
+    (best_estimator), both via (save_artifact). The row is taken by its (index) 
+    label, or the lowest absolute (rmse_avg) if none. Expects (mlpipe_topic) and 
+    (mlpipe_spacy) in kwargs. Returns the published versions. 
+    '''
+
+    # Pick the best performing row. 
+    if index is None: 
+        row = df_performances.iloc[int(np.argmin(df_performances["rmse_avg"].astype(float).abs().to_numpy()))] 
+    else: 
+        row = df_performances.loc[index] 
+
+    # Keep the output columns the estimator was trained on. 
+    components = ast.literal_eval(row["component"]) if isinstance(row["component"], str) else list(row["component"]) 
+    feature_names = row.get("feat_out") 
+    if not isinstance(feature_names, list): 
+        feature_names = getattr(row["estimator"], "feature_names_in_", None) 
+
+    mlpipe_estim = build_estim_pipeline(components, feature_names=feature_names, **kwargs) 
+    mlpipe_estim.fit_transform(X.copy()) 
+
+    # Clear safe warnings. Not important. 
+    clear_output() 
+
+    manage_files = ManageFiles() 
+    return {
+        "mlpipe_estim"   : manage_files.save_artifact(dir=dir, obj_name="mlpipe_estim", object=mlpipe_estim, dev_status=dev_status), 
+        "best_estimator" : manage_files.save_artifact(dir=dir, obj_name="best_estimator", object=row["estimator"], dev_status=dev_status), 
+    } 
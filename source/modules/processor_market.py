@@ -0,0 +1,454 @@
+# %%
+# Python modules.
+import math
+from collections import deque
+import numpy as np
+import pandas as pd
+
+# Custom configs.
+from source.config_py.config import (
+    TICKER_TO_COLLECT, PARAM_MKT_WINDOW, PARAM_MKT_MIN_PERIODS, PARAM_MKT_THRESHOLDS, PARAM_MKT_LAGS,
+    PARAM_NEWS_CUTOFF, PARAM_NEWS_TZ
+)
+
+
+
+# %%
+def feature_suffixes(lags:tuple=PARAM_MKT_LAGS) -> list:
+    '''Names of the market features without the ticker prefix, in the order they are built.'''
+
+    suffixes = ["logret_c2c", "logret_c2c_ravg", "logret_c2c_rstd", "tscore_c2c", "mktmv_c2c"]
+    return suffixes + [f"tscore_c2c_lag_{lag}" for lag in lags]
+
+
+def feature_names(ticker:str="spy", lags:tuple=PARAM_MKT_LAGS) -> list:
+    '''Names of the market features of the (ticker), in the order they are built.'''
+
+    return [f"{ticker.lower()}_{suffix}" for suffix in feature_suffixes(lags)]
+
+
+def movement_scale(tscore, thresholds:tuple=PARAM_MKT_THRESHOLDS) -> np.array:
+    '''
+    Bucket the t-scores into the market movement scale: 0 when at or below the
+    low threshold, 2 when at or above the high threshold, 1 otherwise (including
+    the missing t-scores, as the original labels did).
+    '''
+    return bucketize(tscore, thresholds)
+
+
+def bucketize(values, thresholds:tuple) -> np.array:
+    '''
+    Bucket the values by the sorted (thresholds). The first bucket includes the
+    lowest threshold and the last bucket the highest one, so a low/high pair
+    gives 0 (<= low), 1 and 2 (>= high). Missing values land in the bucket right
+    below the highest threshold.
+    '''
+    values = np.asarray(values, dtype=float)
+    thresholds = np.asarray(thresholds, dtype=float)
+    buckets = np.digitize(values, thresholds[:-1], right=True)
+    return buckets + (values >= thresholds[-1])
+
+
+def compute_market_features(close:pd.Series, ticker:str="spy", window:int=PARAM_MKT_WINDOW, min_periods:int=PARAM_MKT_MIN_PERIODS, thresholds:tuple=PARAM_MKT_THRESHOLDS, lags:tuple=PARAM_MKT_LAGS) -> pd.DataFrame:
+    '''
+    Build the market features of the (ticker) over its whole history from the
+    closing prices:
+        - ({ticker}_logret_c2c) : close to close log return.
+        - ({ticker}_tscore_c2c) : absolute t-score of the log return against its
+          rolling mean/std over the last (window) days.
+        - ({ticker}_mktmv_c2c)  : the t-score bucketed by (thresholds).
+        - ({ticker}_tscore_c2c_lag_{n}) : the t-score (n) days before.
+    '''
+    names = feature_names(ticker, lags)
+    logret = np.log(close) - np.log(close.shift(1))
+
+    # Compute the tscore for price change. Ignore negative sign since we are interested in the movement, not direction.
+    ravg = logret.rolling(window=window, min_periods=min_periods).mean()
+    rstd = logret.rolling(window=window, min_periods=min_periods).std(ddof=1)
+    tscore = ((logret - ravg) / rstd).abs()
+
+    df = pd.DataFrame({
+        names[0]: logret,
+        names[1]: ravg,
+        names[2]: rstd,
+        names[3]: tscore,
+        names[4]: movement_scale(tscore, thresholds),
+    }, index=close.index)
+
+    # Create autocorrelated features for the past N days.
+    for name, lag in zip(names[5:], lags):
+        df[name] = tscore.shift(lag)
+    return df
+
+
+
+# %%
+class RollingTScore():
+    def __init__(self, ticker:str="spy", window:int=PARAM_MKT_WINDOW, min_periods:int=PARAM_MKT_MIN_PERIODS, thresholds:tuple=PARAM_MKT_THRESHOLDS, lags:tuple=PARAM_MKT_LAGS):
+        '''
+        Incremental state of the market features of one ticker. The mean and the
+        sum of squared deviations of the log returns in the window are kept as
+        running sums (Welford's algorithm with removal), so appending a trading
+        day updates every feature in O(1). The sums are recomputed from the
+        window once per (window) appends to keep the rounding errors bounded.
+        The state is picklable and can be saved between the daily runs.
+        '''
+        self.ticker = ticker.lower()
+        self.window = window
+        self.min_periods = min_periods
+        self.thresholds = thresholds
+        self.lags = tuple(lags)
+        self.names = feature_names(ticker, lags)
+
+        self.last_close = np.nan
+        self.last_date = None
+        self.values = deque(maxlen=window)
+        self.tscores = deque([np.nan] * max(self.lags, default=0), maxlen=max(self.lags, default=0))
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self._n_appends = 0
+
+
+    @classmethod
+    def from_history(cls, close:pd.Series, **kwargs):
+        '''
+        Rebuild the state from the price history with the vectorized features,
+        then keep appending the new days with (append).
+        '''
+        state = cls(**kwargs)
+        if close.empty:
+            return state
+
+        features = compute_market_features(close, state.ticker, state.window, state.min_periods, state.thresholds, state.lags)
+        state.values.extend(features[state.names[0]].to_numpy()[-state.window:])
+        state.tscores.extend(features[state.names[3]].to_numpy()[-state.window:])
+        state.last_close = float(close.iloc[-1])
+        state.last_date = close.index[-1]
+        state._resync()
+        return state
+
+
+    def append(self, close:float, date=None) -> dict:
+        '''Add the closing price of the next trading day and return its features.'''
+
+        logret = math.log(close) - math.log(self.last_close) if self.last_close > 0 else np.nan
+        self.last_close = close
+        self.last_date = date
+
+        # Slide the window by one day.
+        if len(self.values) == self.window:
+            self._remove(self.values[0])
+        self.values.append(logret)
+        self._add(logret)
+
+        # Resynchronise the running sums from time to time.
+        self._n_appends += 1
+        if self._n_appends % self.window == 0:
+            self._resync()
+
+        ravg, rstd = self.moments()
+        tscore = abs((logret - ravg) / rstd) if rstd > 0 else np.nan
+
+        features = dict(zip(self.names[:5], [logret, ravg, rstd, tscore, int(movement_scale(tscore, self.thresholds))]))
+        features.update({name: self.tscores[-lag] for name, lag in zip(self.names[5:], self.lags)})
+        self.tscores.append(tscore)
+        return features
+
+
+    def append_many(self, close:pd.Series) -> pd.DataFrame:
+        '''Append the new trading days in order and return their features as a frame.'''
+
+        rows = [self.append(float(value), date) for date, value in close.items()]
+        return pd.DataFrame(rows, index=close.index, columns=self.names)
+
+
+    def moments(self) -> tuple:
+        '''Rolling mean and standard deviation (ddof=1) of the log returns in the window.'''
+
+        if self.n < max(self.min_periods, 1):
+            return np.nan, np.nan
+        std = math.sqrt(max(self.m2, 0.0) / (self.n - 1)) if self.n > 1 else np.nan
+        return self.mean, std
+
+
+    def _add(self, x:float):
+        if math.isnan(x):
+            return
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+
+    def _remove(self, x:float):
+        if math.isnan(x):
+            return
+        self.n -= 1
+        if self.n == 0:
+            self.mean, self.m2 = 0.0, 0.0
+            return
+        delta = x - self.mean
+        self.mean -= delta / self.n
+        self.m2 -= delta * (x - self.mean)
+
+
+    def _resync(self):
+        values = np.array(self.values, dtype=float)
+        values = values[~np.isnan(values)]
+        self.n = values.size
+        self.mean = float(values.mean()) if self.n else 0.0
+        self.m2 = float(((values - self.mean) ** 2).sum()) if self.n else 0.0
+
+
+
+# %%
+def load_price_panel(tickers:list=TICKER_TO_COLLECT, filename:str="yfinance_{ticker}.csv", price:str="close", manage_files=None) -> tuple:
+    '''
+    Load the local price snapshots of the (tickers) into a (date x ticker)
+    float32 array. The (filename) is formatted with the lowercased ticker. Each
+    file holds a date column and either a (Close) column as downloaded from
+    yfinance or a ({ticker}_close) column as built by the notebooks. The dates
+    are the union of the dates of every ticker, the gaps are left as NaN.
+
+    Returns the (dates), the lowercased (tickers) and the (prices).
+    '''
+    from source.modules.manage_files import ManageFiles
+
+    manage_files = manage_files or ManageFiles()
+    tickers = [ticker.lower() for ticker in tickers]
+
+    series = []
+    for ticker in tickers:
+        df = manage_files.read_from_csv(filename=filename.format(ticker=ticker))
+        series.append(_price_column(df, ticker, price))
+
+    panel = pd.concat(series, axis="columns", keys=tickers, sort=True)
+    return panel.index, tickers, panel.to_numpy(dtype=np.float32)
+
+
+def _price_column(df:pd.DataFrame, ticker:str, price:str="close") -> pd.Series:
+    '''Take the price column of the (ticker), indexed by the normalized date.'''
+
+    columns = {col.lower(): col for col in df.columns}
+    date_col = columns.get("date", df.columns[0])
+    price_col = columns.get(f"{ticker}_{price}", columns.get(price))
+    if price_col is None:
+        raise KeyError(f"No ({price}) or ({ticker}_{price}) column in the prices of ({ticker}).")
+
+    dates = pd.to_datetime(df[date_col], utc=True).dt.tz_localize(None).dt.normalize()
+    return pd.Series(df[price_col].to_numpy(), index=pd.DatetimeIndex(dates, name="date"))
+
+
+def compute_panel_features(prices:np.array, window:int=PARAM_MKT_WINDOW, min_periods:int=PARAM_MKT_MIN_PERIODS, thresholds:tuple=PARAM_MKT_THRESHOLDS, lags:tuple=PARAM_MKT_LAGS) -> dict:
+    '''
+    Build the market features of every ticker at once from the (date x ticker)
+    closing prices. The rolling mean/std come from prefix sums over the date
+    axis, so the cost does not depend on the window length. Returns a dict of
+    (date x ticker) arrays keyed by the feature suffixes, float32 except the
+    movement scale (int8). The windows count the rows of the shared dates.
+    '''
+    prices = np.asarray(prices, dtype=np.float32)
+    suffixes = feature_suffixes(lags)
+
+    # Compute the log return of the ticker prices.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        logret = np.full(prices.shape, np.nan, dtype=np.float32)
+        logret[1:] = np.diff(np.log(prices), axis=0)
+
+    # Compute the tscore for price change. Ignore negative sign since we are interested in the movement, not direction.
+    ravg, rstd = rolling_moments(logret, window, min_periods)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tscore = np.abs((logret - ravg) / rstd)
+
+    features = dict(zip(suffixes[:5], [logret, ravg, rstd, tscore, movement_scale(tscore, thresholds).astype(np.int8)]))
+
+    # Create autocorrelated features for the past N days.
+    for suffix, lag in zip(suffixes[5:], lags):
+        features[suffix] = shift_rows(tscore, lag)
+    return features
+
+
+def rolling_moments(values:np.array, window:int, min_periods:int=None) -> tuple:
+    '''
+    Rolling mean and standard deviation (ddof=1) along the first axis, ignoring
+    the NaNs like pandas does.
+    '''
+    values = np.asarray(values)
+    mean, std = _windowed_moments(*_prefix_sums(values), [window], min_periods)
+    return mean[:, 0].astype(values.dtype), std[:, 0].astype(values.dtype)
+
+
+def _prefix_sums(values:np.array) -> tuple:
+    '''
+    Prefix sums (in float64) of the valid counts, values and squared values
+    along the first axis. Each column is centred on its mean beforehand to
+    limit the cancellation errors when taking the differences.
+    '''
+    valid = ~np.isnan(values)
+    with np.errstate(invalid="ignore"):
+        centre = np.nanmean(np.where(valid.any(axis=0), values, 0), axis=0)
+    centred = np.where(valid, values - centre, 0).astype(np.float64)
+
+    prefix = np.zeros((3, values.shape[0] + 1) + values.shape[1:], dtype=np.float64)
+    for i, x in enumerate((valid, centred, centred ** 2)):
+        np.cumsum(x, axis=0, out=prefix[i, 1:])
+    return centre, prefix
+
+
+def _windowed_moments(centre:np.array, prefix:np.array, windows:list, min_periods:int=None) -> tuple:
+    '''
+    Rolling mean and standard deviation for every window length at once, taking
+    the window sums as the differences of the prefix sums. The window axis is
+    inserted right after the first axis. Without (min_periods), each window
+    needs to be full.
+    '''
+    windows = np.asarray(windows, dtype=np.int64)
+    n_rows = prefix.shape[1] - 1
+
+    # Row (t) of window (w) covers the rows (t - w, t].
+    start = np.maximum(np.arange(1, n_rows + 1)[:, None] - windows[None, :], 0)
+    count, sum1, sum2 = prefix[:, 1:, None] - prefix[:, start]
+
+    min_periods = windows if min_periods is None else np.full_like(windows, min_periods)
+    min_periods = np.maximum(min_periods, 1).reshape((1, -1) + (1,) * (count.ndim - 2))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = sum1 / count
+        var = np.maximum(sum2 - sum1 * mean, 0) / (count - 1)
+    enough = (count >= min_periods)
+    mean = np.where(enough, mean + centre, np.nan)
+    std = np.where(enough & (count > 1), np.sqrt(var), np.nan)
+    return mean, std
+
+
+def shift_rows(values:np.array, lag:int) -> np.array:
+    '''Shift the rows down by (lag), filling the first rows with NaN.'''
+
+    shifted = np.full_like(values, np.nan)
+    if lag < values.shape[0]:
+        shifted[lag:] = values[:values.shape[0] - lag]
+    return shifted
+
+
+def panel_to_frame(dates, tickers:list, features:dict) -> pd.DataFrame:
+    '''Lay the panel features out as ({ticker}_{feature}) columns, like the notebooks do.'''
+
+    frames = {
+        f"{ticker}_{suffix}": values[:, i]
+        for i, ticker in enumerate(tickers)
+        for suffix, values in features.items()
+    }
+    return pd.DataFrame(frames, index=pd.DatetimeIndex(dates, name="date"))
+
+
+
+# %%
+def compute_window_cube(logret:np.array, windows:list, min_periods:int=None, thresholds:tuple=PARAM_MKT_THRESHOLDS) -> dict:
+    '''
+    Build the rolling mean/std, t-score and movement scale of the log returns
+    for every window length in (windows) at once. The prefix sums of the
+    returns and squared returns are taken once, so sweeping many windows costs
+    about the same as one. The arrays are (date x window), or (date x window x
+    ticker) for a panel of log returns.
+    '''
+    logret = np.asarray(logret, dtype=float)
+    ravg, rstd = _windowed_moments(*_prefix_sums(logret), windows, min_periods)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tscore = np.abs((logret[:, None] - ravg) / rstd)
+
+    return {
+        "logret_c2c_ravg"   : ravg,
+        "logret_c2c_rstd"   : rstd,
+        "tscore_c2c"        : tscore,
+        "mktmv_c2c"         : bucketize(tscore, thresholds).astype(np.int8),
+    }
+
+
+def sweep_thresholds(tscore:np.array, thresholds:list) -> np.array:
+    '''Bucket the t-scores by each set of (thresholds), stacked on a new last axis.'''
+
+    return np.stack([bucketize(tscore, values) for values in thresholds], axis=-1).astype(np.int8)
+
+
+def cube_to_frame(dates, windows:list, cube:dict) -> pd.DataFrame:
+    '''Lay a (date x window) cube out as ({feature}_w{window}) columns.'''
+
+    frames = {
+        f"{name}_w{window}": values[:, i]
+        for name, values in cube.items()
+        for i, window in enumerate(windows)
+    }
+    return pd.DataFrame(frames, index=pd.DatetimeIndex(dates, name="date"))
+
+
+
+# %%
+def trading_calendar(dates) -> np.array:
+    '''Sorted unique trading days (datetime64[D]) of the market data index.'''
+
+    dates = pd.DatetimeIndex(dates)
+    if dates.tz is not None:
+        dates = dates.tz_localize(None)
+    return np.unique(dates.to_numpy().astype("datetime64[D]"))
+
+
+def align_to_sessions(published, calendar:np.array, cutoff:str=PARAM_NEWS_CUTOFF, tz:str=PARAM_NEWS_TZ) -> np.array:
+    '''
+    As-of join of the publication times to the trading (calendar). An article
+    belongs to the session of its day when published before the (cutoff), and
+    to the next trading session otherwise, including the articles of weekends
+    and holidays. Timezone-aware times are converted to the exchange timezone
+    (tz) first, naive ones are taken as exchange time. Returns the position of
+    the session in the (calendar) for each article, -1 past the last session.
+    '''
+    published = pd.DatetimeIndex(pd.to_datetime(published))
+    if published.tz is not None:
+        published = published.tz_convert(tz).tz_localize(None)
+
+    # Move the articles published after the cutoff to the next day.
+    days = published.normalize()
+    after_cutoff = (published - days) >= pd.Timedelta(f"{cutoff}:00")
+    days = days.to_numpy().astype("datetime64[D]") + after_cutoff.astype(np.int64)
+
+    # Take the first trading session on or after that day.
+    position = np.searchsorted(calendar, days, side="left")
+    position[(position >= len(calendar)) | published.isna()] = -1
+    return position
+
+
+def join_news_to_market(df_news:pd.DataFrame, df_market:pd.DataFrame, time_col:str="date_published", session_col:str="session", usecols:list=None, cutoff:str=PARAM_NEWS_CUTOFF, tz:str=PARAM_NEWS_TZ) -> pd.DataFrame:
+    '''
+    Attach the market features of the trading session of each article, instead
+    of merging on the calendar date and dropping the weekend and holiday news.
+    The (df_market) is indexed by trading day. The session date is kept in
+    (session_col); the articles past the last session get missing values.
+    '''
+    df_market = df_market.sort_index()
+    usecols = list(df_market.columns) if usecols is None else usecols
+    calendar = trading_calendar(df_market.index)
+    position = align_to_sessions(df_news[time_col], calendar, cutoff, tz)
+    matched = position >= 0
+
+    df = df_news.copy()
+    df[session_col] = pd.to_datetime(np.where(matched, calendar[position], np.datetime64("NaT")))
+
+    # Gather the market rows by position rather than merging on the date.
+    for col in usecols:
+        values = df_market[col].to_numpy()
+        df[col] = np.where(matched, values[position], np.nan) if not matched.all() else values[position]
+    return df
+
+
+def aggregate_sessions(df:pd.DataFrame, session_col:str="session", **agg) -> pd.DataFrame:
+    '''
+    Aggregate the articles of the same trading session. The (agg) are named
+    aggregations as in (DataFrame.groupby().agg), e.g.
+    (sentiment_avg=("sentiment_score", "mean")). The # of articles is always
+    reported in (n_articles).
+    '''
+    grouped = df.groupby(session_col, sort=True)
+    df_agg = grouped.agg(**agg) if agg else pd.DataFrame(index=grouped.size().index)
+    df_agg["n_articles"] = grouped.size()
+    return df_agg
@@ -0,0 +1,387 @@
+# %%
+# Python modules.
+import sys, json, time, queue, argparse, threading
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+
+# Custom modules.
+from source.modules.model_registry import get_model
+
+# Custom configs.
+from source.config_py.config import (
+    PARAM_SPACY_BATCH_SIZE, PARAM_SCORING_MAX_BATCH, PARAM_SCORING_MAX_LATENCY,
+    PARAM_SCORING_HOST, PARAM_SCORING_PORT
+)
+
+
+
+# %%
+class LatencyStats():
+    def __init__(self, window:int=10000):
+        '''
+        Thread-safe counters of the scoring service. The latencies of the last
+        (window) requests are kept to report the p50/p99 percentiles.
+        '''
+        self.latencies = deque(maxlen=window)
+        self.n_requests = 0
+        self.n_errors = 0
+        self.n_batches = 0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record_request(self, latency:float, failed:bool=False):
+        with self._lock:
+            self.latencies.append(latency)
+            self.n_requests += 1
+            self.n_errors += int(failed)
+
+    def record_batch(self):
+        with self._lock:
+            self.n_batches += 1
+
+    def snapshot(self) -> dict:
+        '''Report the latency percentiles (in milliseconds) and the throughput.'''
+
+        with self._lock:
+            latencies = np.array(self.latencies, dtype=float) * 1000
+            n_requests, n_errors, n_batches = self.n_requests, self.n_errors, self.n_batches
+        elapsed = time.monotonic() - self.started
+
+        return {
+            "requests"          : n_requests,
+            "errors"            : n_errors,
+            "batches"           : n_batches,
+            "avg_batch_size"    : n_requests / n_batches if n_batches else 0.0,
+            "throughput_rps"    : n_requests / elapsed if elapsed else 0.0,
+            "latency_p50_ms"    : float(np.percentile(latencies, 50)) if latencies.size else 0.0,
+            "latency_p99_ms"    : float(np.percentile(latencies, 99)) if latencies.size else 0.0,
+            "uptime_s"          : elapsed,
+        }
+
+
+
+# %%
+class MicroBatcher():
+    def __init__(self, func, max_batch_size:int=PARAM_SCORING_MAX_BATCH, max_latency:float=PARAM_SCORING_MAX_LATENCY, stats:LatencyStats=None):
+        '''
+        Collect the submitted items into micro-batches and pass each batch to
+        (func) in a background thread. A batch is flushed once it holds
+        (max_batch_size) items or its oldest item waited for (max_latency)
+        seconds. (func) receives a list of items and returns one result per item.
+        '''
+        self.func = func
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.stats = stats or LatencyStats()
+        self._queue = queue.Queue()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, item) -> Future:
+        '''Queue the item and return the future of its result.'''
+
+        if self._closed:
+            raise RuntimeError("The micro-batcher is closed.")
+
+        future = Future()
+        started = time.monotonic()
+        future.add_done_callback(
+            lambda f: self.stats.record_request(time.monotonic() - started, failed=f.exception() is not None)
+        )
+        self._queue.put((item, future))
+        return future
+
+    def close(self):
+        '''Score the queued items and stop the worker.'''
+
+        self._closed = True
+        self._queue.put(None)
+        self._worker.join()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            entry = self._queue.get()
+            if entry is None:
+                break
+
+            # Wait for more items until the batch is full or the deadline is reached.
+            batch = [entry]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    entry = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stop = True
+                    break
+                batch.append(entry)
+
+            self._process(batch)
+
+    def _process(self, batch:list):
+        items = [item for item, _ in batch]
+        futures = [future for _, future in batch]
+
+        # When the batch fails, score the items one by one so that only the bad
+        # ones fail and not the other requests sharing the batch.
+        try:
+            self._resolve(futures, self._call(items))
+        except Exception as err:
+            if len(batch) == 1:
+                futures[0].set_exception(err)
+            else:
+                for item, future in batch:
+                    try:
+                        self._resolve([future], self._call([item]))
+                    except Exception as item_err:
+                        future.set_exception(item_err)
+        self.stats.record_batch()
+
+    def _call(self, items:list) -> list:
+        results = list(self.func(items))
+        if len(results) != len(items):
+            raise ValueError(f"Got ({len(results)}) results for ({len(items)}) items.")
+        return results
+
+    def _resolve(self, futures:list, results:list):
+        for future, result in zip(futures, results):
+            future.set_result(result)
+
+
+
+# %%
+class ScoringService():
+    def __init__(self, feature_pipe:str="mlpipe_estim", estimator:str="best_estimator", max_batch_size:int=PARAM_SCORING_MAX_BATCH, max_latency:float=PARAM_SCORING_MAX_LATENCY, target:str="spy_tscore_c2c"):
+        '''
+        Resident scoring process. The feature pipeline (sentiment and topic
+        extraction, encoding) and the best estimator are loaded once from the
+        model registry. Each micro-batch of headlines goes through the pipeline
+        and the regression in one pass to predict the (target).
+
+        Each record holds the (headline), its entity titles under (theme_sub) or
+        the raw Wikifier (entities), and the lagged t-scores used by the model.
+        Set (estimator) to None when the pipeline ends with the regressor.
+        '''
+        self.target = target
+        self.features = get_model(feature_pipe)
+        self.estimator = get_model(estimator) if estimator else None
+        self._use_batched_sentiment()
+
+        self.stats = LatencyStats()
+        self.batcher = MicroBatcher(self.predict_batch, max_batch_size, max_latency, stats=self.stats)
+
+    def score(self, record:dict, timeout:float=None) -> dict:
+        '''Score a single headline, waiting for its micro-batch.'''
+
+        return self.score_many([record], timeout)[0]
+
+    def score_many(self, records:list, timeout:float=None) -> list:
+        '''Submit the headlines together so they can share the micro-batches.'''
+
+        futures = [self.submit(record) for record in records]
+        return [self._response(record, future, timeout) for record, future in zip(records, futures)]
+
+    def submit(self, record:dict) -> Future:
+        '''Queue the record for the next micro-batch, rejecting malformed ones on their own.'''
+
+        if not isinstance(record, dict):
+            future = Future()
+            future.set_exception(TypeError(f"Expected a JSON object, got ({type(record).__name__})."))
+            return future
+        return self.batcher.submit(record)
+
+    def predict_batch(self, records:list) -> np.array:
+        '''Predict the (target) of a batch of records in one vectorized pass.'''
+
+        X = self.to_frame(records)
+        if self.estimator is None:
+            return self.features.predict(X)
+        return self.estimator.predict(self.features.transform(X))
+
+    def to_frame(self, records:list) -> pd.DataFrame:
+        '''Build the input frame, taking the entity titles as (theme_sub) if needed.'''
+
+        df = pd.DataFrame.from_records(records)
+        if "theme_sub" not in df.columns and "entities" in df.columns:
+            df["theme_sub"] = df["entities"].str["title"]
+
+        # The columns missing from every record are left empty.
+        for col in self._input_columns():
+            if col not in df.columns:
+                df[col] = np.nan
+        return df
+
+    def close(self):
+        self.batcher.close()
+
+    def _response(self, record:dict, future:Future, timeout:float=None) -> dict:
+        out = {"id": record.get("id")} if isinstance(record, dict) and "id" in record else dict()
+        try:
+            score = float(future.result(timeout))
+        except Exception as err:
+            out["error"] = f"{type(err).__name__}: {err}"
+            return out
+
+        # NaN is not valid JSON, a missing input (e.g. a lag) gives a null score.
+        if np.isfinite(score):
+            out[self.target] = score
+        else:
+            out[self.target] = None
+            out["error"] = f"ValueError: non-finite prediction ({score}), check the inputs of the record."
+        return out
+
+    def _input_columns(self) -> list:
+        steps = getattr(self.features, "steps", [])
+        if steps and hasattr(steps[0][1], "var_proc"):
+            return list(steps[0][1].var_proc)
+        return []
+
+    def _use_batched_sentiment(self):
+        '''Stream the headlines through SpaCy in batches instead of one by one.'''
+
+        from source.modules.processor_estim import ExtractSentiment
+
+        for _, step in getattr(self.features, "steps", []):
+            if isinstance(step, ExtractSentiment) and getattr(step, "batch_size", None) is None:
+                step.batch_size = PARAM_SPACY_BATCH_SIZE
+
+
+
+# %%
+def serve_stdio(service:ScoringService, infile=None, outfile=None):
+    '''
+    Serve the JSON-lines protocol. Each input line is a record to score, or
+    ({"cmd": "stats"}) for the counters. The responses are written in the order
+    of the input lines while the records are scored in micro-batches.
+    '''
+    infile = infile or sys.stdin
+    outfile = outfile or sys.stdout
+    pending = queue.Queue()
+
+    # Write the responses in order as their batches complete.
+    def write_responses():
+        while True:
+            entry = pending.get()
+            if entry is None:
+                break
+            record, result = entry
+            if isinstance(result, Future):
+                result = service._response(record, result)
+            outfile.write(json.dumps(result) + "\n")
+            outfile.flush()
+
+    writer = threading.Thread(target=write_responses, name="stdio-writer", daemon=True)
+    writer.start()
+
+    for line in infile:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as err:
+            pending.put((None, {"error": f"JSONDecodeError: {err}"}))
+            continue
+
+        if isinstance(record, dict) and record.get("cmd") == "stats":
+            pending.put((record, service.stats.snapshot()))
+        else:
+            pending.put((record, service.submit(record)))
+
+    pending.put(None)
+    writer.join()
+
+
+
+# %%
+def make_handler(service:ScoringService):
+    '''
+    Build the HTTP handler of the service:
+        - POST /score : a record or a list of records, returns the predictions.
+        - GET /stats  : the latency and throughput counters.
+        - GET /health : liveness check.
+    '''
+
+    class ScoringHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send(200, service.stats.snapshot())
+            elif self.path == "/health":
+                self._send(200, {"status": "ok"})
+            else:
+                self._send(404, {"error": f"Unknown path ({self.path})."})
+
+        def do_POST(self):
+            if self.path != "/score":
+                self._send(404, {"error": f"Unknown path ({self.path})."})
+                return
+
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length))
+            except (ValueError, json.JSONDecodeError) as err:
+                self._send(400, {"error": f"{type(err).__name__}: {err}"})
+                return
+
+            if isinstance(payload, list):
+                self._send(200, service.score_many(payload))
+            else:
+                self._send(200, service.score(payload))
+
+        def _send(self, status:int, body):
+            data = json.dumps(body).encode("utf8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ScoringHandler
+
+
+def serve_http(service:ScoringService, host:str=PARAM_SCORING_HOST, port:int=PARAM_SCORING_PORT):
+    '''Serve the scoring service over HTTP. Each connection has its own thread.'''
+
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    print(f"Serve scoring on (http://{host}:{port})", file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+
+# %%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score live headlines with the best market movement estimator.")
+    parser.add_argument("--mode", choices=["stdio", "http"], default="stdio")
+    parser.add_argument("--host", default=PARAM_SCORING_HOST)
+    parser.add_argument("--port", type=int, default=PARAM_SCORING_PORT)
+    parser.add_argument("--max-batch-size", type=int, default=PARAM_SCORING_MAX_BATCH)
+    parser.add_argument("--max-latency", type=float, default=PARAM_SCORING_MAX_LATENCY)
+    args = parser.parse_args()
+
+    # Keep stdout for the responses, the progress messages go to stderr.
+    protocol_out = sys.stdout
+    sys.stdout = sys.stderr
+
+    service = ScoringService(max_batch_size=args.max_batch_size, max_latency=args.max_latency)
+    try:
+        if args.mode == "http":
+            serve_http(service, args.host, args.port)
+        else:
+            serve_stdio(service, outfile=protocol_out)
+    finally:
+        service.close()
+        print(json.dumps(service.stats.snapshot()), file=sys.stderr)
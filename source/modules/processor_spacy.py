@@ -1,54 +1,141 @@
 # %%
 # Python modules. 
-import spacy 
+from collections import OrderedDict 
+from functools import lru_cache 
+import numpy as np 
+
+# Custom modules. 
+from source.modules.model_registry import get_model 
 
 # Custom configs. 
-from source.config_py.config import DIR_MLSPACY 
+from source.config_py.config import PARAM_SHAP_CACHE_SIZE, PARAM_SPACY_BATCH_SIZE, PARAM_SPACY_KEEP_PIPES 
 
 
 
 # %%
-# Loading the best model. 
-mlpipe_spacy = spacy.load(f"{DIR_MLSPACY}/model-best") 
-tokenz_spacy = spacy.tokenizer.Tokenizer(mlpipe_spacy.vocab) 
+def __getattr__(name:str): 
+    '''
+    The best model and its tokenizer are loaded on first use from the model 
+    registry instead of at import time. (mlpipe_spacy) and (tokenz_spacy) 
+    remain available as module attributes. 
+    '''
+    if name in ("mlpipe_spacy", "tokenz_spacy"): 
+        return get_model(name) 
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}") 
 
 
 
 # %%
-def sentiment_predictor(texts): 
+class SentimentPredictor(): 
+    def __init__(self, maxsize:int=PARAM_SHAP_CACHE_SIZE, batch_size:int=PARAM_SPACY_BATCH_SIZE, keep_pipes:tuple=PARAM_SPACY_KEEP_PIPES): 
+        '''
+        Memoized predictor for SHAP. The explainer calls the predictor with many 
+        masked variants of the same text, so the scores are kept in an LRU cache 
+        keyed by text. Only the texts not seen yet (deduplicated) are streamed 
+        through the SpaCy pipeline in batches. 
+        '''
+        self.maxsize = maxsize 
+        self.batch_size = batch_size 
+        self.keep_pipes = keep_pipes 
+        self.cache = OrderedDict() 
+        self.hits = 0 
+        self.misses = 0 
+
+    def __call__(self, texts) -> np.ndarray: 
+        '''Return the (text x label) score matrix for the texts.'''
+
+        # Convert texts to bare strings. 
+        texts = [str(text) for text in texts] 
+        scores = dict() 
+        missing = [] 
+
+        # Deduplicate the texts and take the cached scores. 
+        for text in dict.fromkeys(texts): 
+            if text in self.cache: 
+                self.cache.move_to_end(text) 
+                scores[text] = self.cache[text] 
+            else: 
+                missing.append(text) 
+
+        # Predict the sentiment of the texts not cached yet. 
+        if missing: 
+            scores.update(zip(missing, self._predict(missing))) 
+            for text in missing: 
+                self.cache[text] = scores[text] 
+
+            # Evict the least recently used texts. 
+            while len(self.cache) > self.maxsize: 
+                self.cache.popitem(last=False) 
+
+        self.misses += len(missing) 
+        self.hits += len(texts) - len(missing) 
+
+        if not texts: 
+            return np.empty((0, len(self.labels)), dtype=np.float32) 
+        return np.vstack([scores[text] for text in texts]) 
+
+    @property 
+    def labels(self) -> list: 
+        return list(get_model("mlpipe_spacy").get_pipe("textcat").labels) 
+
+    def _predict(self, texts:list) -> np.ndarray: 
+        '''Score the texts in batches with the pipes the textcat does not need disabled.'''
+
+        mlpipe_spacy = get_model("mlpipe_spacy") 
+        labels = self.labels 
+        disable = [pipe for pipe in mlpipe_spacy.pipe_names if pipe not in self.keep_pipes] 
+
+        scores = np.empty((len(texts), len(labels)), dtype=np.float32) 
+        for i, doc in enumerate(mlpipe_spacy.pipe(texts, batch_size=self.batch_size, disable=disable)): 
+            scores[i] = [doc.cats[cat] for cat in labels] 
+        return scores 
+
+    def clear(self): 
+        '''Drop the cached scores, e.g. after the model is reloaded.'''
+
+        self.cache.clear() 
+        self.hits, self.misses = 0, 0 
+
+
+
+# The predictor shared by the SHAP explainers of the process. 
+predictor = SentimentPredictor() 
+
+
+def sentiment_predictor(texts) -> np.ndarray: 
     '''
     To make prediction via SpaCy model, so that SHAP can evaluate the model. 
+    Identical texts are scored once and kept in the cache across calls. 
     '''
-    mlpipe_class = list(mlpipe_spacy.get_pipe("textcat").labels) 
-
-    # Convert texts to bare strings. 
-    texts = [str(text) for text in texts] 
-    results = []
-    
-    # Predict the sentitment. 
-    for doc in mlpipe_spacy.pipe(texts): 
-        results.append([doc.cats[cat] for cat in mlpipe_class]) 
-    return results
+    return predictor(texts) 
 
 
 
 # %%
+@lru_cache(maxsize=PARAM_SHAP_CACHE_SIZE) 
+def _tokenize(text:str) -> tuple: 
+    '''Tokenize the text once and keep the normalized tokens and their spans.'''
+
+    doc = get_model("tokenz_spacy")(text) 
+    return tuple(tok.norm for tok in doc), tuple((tok.idx, tok.idx + len(tok)) for tok in doc) 
+
+
 def token_wrapper(text, return_offsets_mapping=False):
     '''
     A function to create a transformers-like tokenizer to match shap's expectations.
     We are taking the normalized tokens by default. Check this out for reference on
     normalization: 
         - https://newscatcherapi.com/blog/spacy-vs-nltk-text-normalization-comparison-with-code-examples 
+    The tokenization of each text is cached, the lists returned are fresh copies. 
     '''
 
     # Split text into tokens. 
-    doc = tokenz_spacy(text) 
+    input_ids, offsets = _tokenize(str(text)) 
 
     # Extract the normalized token. 
-    # Check this: 
-    out = {"input_ids": [tok.norm for tok in doc]}
+    out = {"input_ids": list(input_ids)}
 
     # Take the span of a token. 
     if return_offsets_mapping:
-        out["offset_mapping"] = [(tok.idx, tok.idx + len(tok)) for tok in doc] 
+        out["offset_mapping"] = list(offsets) 
     return out
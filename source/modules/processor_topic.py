@@ -5,12 +5,21 @@ import spacy
 import numpy as np 
 import pandas as pd
 from collections import defaultdict 
+from scipy import sparse 
+from scipy.optimize import linear_sum_assignment 
+from sklearn.base import BaseEstimator, TransformerMixin 
+from sklearn.decomposition import NMF 
+from sklearn.feature_extraction import FeatureHasher 
 from sklearn.metrics.pairwise import cosine_similarity 
+from sklearn.preprocessing import normalize 
+from sklearn.utils import check_random_state, gen_batches 
+from sklearn.utils.validation import check_is_fitted 
 
 # Custom configs. 
 from source.config_py.config import (
     WIKIFIER_URL, PARAM_THRESHOLD, PARAM_LANG, 
-    PARAM_N_TOPIC, PARAM_TOP_N_TERM 
+    PARAM_SEED, PARAM_N_TOPIC, PARAM_TOP_N_TERM, PARAM_HASH_N_FEATURES, 
+    PARAM_SPACY_BATCH_SIZE, PARAM_SPACY_N_PROCESS 
 )
 
 
@@ -19,7 +28,28 @@ from source.config_py.config import (
 def resolve_coref(text:str, nlp:spacy.tokens.doc.Doc): 
     '''Identify the co-referencing part for the body text and replace them.'''
 
-    doc = nlp(text)
+    return resolve_coref_doc(nlp(text)) 
+
+
+
+# %%
+def resolve_coref_pipe(texts, nlp:spacy.tokens.doc.Doc, batch_size:int=PARAM_SPACY_BATCH_SIZE, n_process:int=PARAM_SPACY_N_PROCESS): 
+    '''
+    Resolve the co-references for an iterable of texts. The texts are streamed 
+    through (nlp.pipe) and the resolved strings are yielded one by one, so the 
+    memory use does not grow with the corpus size. The coreference component 
+    must support (n_process) above 1 for its annotations to reach the main 
+    process. 
+    '''
+
+    for doc in nlp.pipe(texts, batch_size=batch_size, n_process=n_process): 
+        yield resolve_coref_doc(doc) 
+
+
+
+# %%
+def resolve_coref_doc(doc:spacy.tokens.doc.Doc) -> str: 
+    '''Replace the co-referencing part of a processed document.'''
 
     # Get the tokens including whitespaces from (spacy doc object). 
     tokens = list(token.text_with_ws for token in doc)
@@ -52,10 +82,32 @@ def wikifier_extract(text:str, lang:str=PARAM_LANG, threshold:int=PARAM_THRESHOL
     ''' 
     
     # URL parameter setup. 
-    data = urllib.parse.urlencode([
+    data = urllib.parse.urlencode(get_wikifier_params(text, lang=lang, threshold=threshold)) 
+
+    # Receive the POST response from Wikifier. 
+    request = urllib.request.Request(WIKIFIER_URL, data=data.encode("utf8"), method="POST") 
+    with urllib.request.urlopen(request, timeout=60) as f: 
+        response = f.read() 
+        response = json.loads(response.decode("utf8")) 
+
+    # Sleep for a while to avoid rate limit issue. 
+    time.sleep(2) 
+
+    return parse_wikifier_response(response) 
+
+
+
+# %%
+def get_wikifier_params(text:str, lang:str=PARAM_LANG, threshold:int=PARAM_THRESHOLD, user_key:str=None) -> list: 
+    '''
+    Get the list of (name, value) URL parameters for the Wikifier request. The user 
+    key is read from the (WIKIFIER_USERKEY) environment variable if not given. 
+    ''' 
+
+    return [
         ("text", text), 
         ("lang", lang),
-        ("userKey", os.environ["WIKIFIER_USERKEY"]), 
+        ("userKey", os.environ["WIKIFIER_USERKEY"] if user_key is None else user_key), 
         ("pageRankSqThreshold", str(threshold)), 
         ("applyPageRankSqThreshold", "true"), 
         ("nTopDfValuesToIgnore", "100"), 
@@ -68,16 +120,13 @@ def wikifier_extract(text:str, lang:str=PARAM_LANG, threshold:int=PARAM_THRESHOL
         ("includeCosines", "false"), 
         ("maxMentionEntropy", "3"), 
         ("partsOfSpeech", "true"), 
-    ])
+    ]
 
-    # Receive the POST response from Wikifier. 
-    request = urllib.request.Request(WIKIFIER_URL, data=data.encode("utf8"), method="POST") 
-    with urllib.request.urlopen(request, timeout=60) as f: 
-        response = f.read() 
-        response = json.loads(response.decode("utf8")) 
 
-    # Sleep for a while to avoid rate limit issue. 
-    time.sleep(2) 
+
+# %%
+def parse_wikifier_response(response:dict) -> dict: 
+    '''Extract the entities and POS tags from the Wikifier JSON response.''' 
 
     # Need to convert the (collections.defaultdict) object to normal (dict) object 
     # later, so that we can save the object in (Parquet) format. 
@@ -127,55 +176,261 @@ def raw_token_input(tokens:list) -> list:
 
 
 # %%
-def get_topic_similarity(component:np.array) -> pd.DataFrame: 
-    '''Get cosine similarity score between each pair of topics.''' 
-    # Topic names. 
-    topic_names = [f"TP{topic_i}" for topic_i in range(0, PARAM_N_TOPIC)] 
+class HashedEntityVectorizer(BaseEstimator, TransformerMixin): 
+    def __init__(self, n_features:int=PARAM_HASH_N_FEATURES, key:str="wikiId", norm:str="l2", use_idf:bool=True, smooth_idf:bool=True, sublinear_tf:bool=False): 
+        '''
+        TF-IDF over the entities with the hashing trick instead of a vocabulary. 
+        Each document is a list of entities, or the Wikifier (entities) dict in 
+        which case the (key) list is taken (the stable Wikidata IDs by default). 
+        The entities are hashed (MurmurHash3, stable across processes) into 
+        (n_features) columns and the document frequencies are kept as counts, 
+        so (partial_fit) can update the IDF as new articles arrive and the 
+        fitted state stays a fixed-size array. It can replace the 
+        (TfidfVectorizer(analyzer=raw_token_input)) stage in front of the NMF. 
+        '''
+        self.n_features = n_features 
+        self.key = key 
+        self.norm = norm 
+        self.use_idf = use_idf 
+        self.smooth_idf = smooth_idf 
+        self.sublinear_tf = sublinear_tf 
+
+    def fit(self, X, y=None): 
+        for attr in ("n_docs_", "doc_freq_"): 
+            self.__dict__.pop(attr, None) 
+        return self.partial_fit(X) 
+
+    def partial_fit(self, X, y=None): 
+        '''Add the document frequencies of the entities in (X).'''
+
+        counts = self._count(X) 
+        if not hasattr(self, "doc_freq_"): 
+            self.n_docs_ = 0 
+            self.doc_freq_ = np.zeros(self.n_features, dtype=np.int64) 
+
+        # Each column appears once per row after the duplicates are summed. 
+        self.doc_freq_ += np.bincount(counts.indices, minlength=self.n_features) 
+        self.n_docs_ += counts.shape[0] 
+        return self 
+
+    def transform(self, X): 
+        check_is_fitted(self, "doc_freq_") 
+
+        X = self._count(X).astype(np.float64) 
+        if self.sublinear_tf: 
+            X.data = np.log(X.data) + 1 
+        if self.use_idf: 
+            X.data *= self.idf_[X.indices] 
+        if self.norm: 
+            X = normalize(X, norm=self.norm, copy=False) 
+        return X 
+
+    @property 
+    def idf_(self) -> np.array: 
+        '''Inverse document frequency, computed as the (TfidfVectorizer) does.'''
+
+        smooth = int(self.smooth_idf) 
+        with np.errstate(divide="ignore"): 
+            return np.log((self.n_docs_ + smooth) / (self.doc_freq_ + smooth)) + 1 
+
+    def get_feature_names_out(self, input_features=None) -> np.array: 
+        return np.array([f"hash_{i}" for i in range(self.n_features)], dtype=object) 
+
+    def get_feature_index(self, entities:list) -> np.array: 
+        '''Column of each entity, e.g. to label the top columns of the topics.'''
+
+        return self._hasher().transform([[str(entity)] for entity in entities]).indices 
+
+    def _count(self, X): 
+        return self._hasher().transform(self._entities(doc) for doc in X) 
+
+    def _entities(self, doc) -> list: 
+        if isinstance(doc, dict): 
+            doc = doc.get(self.key) 
+        if doc is None or isinstance(doc, float): 
+            return [] 
+        if isinstance(doc, str): 
+            return [doc] 
+        return [str(entity) for entity in doc] 
+
+    def _hasher(self) -> FeatureHasher: 
+        return FeatureHasher(n_features=self.n_features, input_type="string", alternate_sign=False) 
 
-    # Compute cosine similarity score. 
-    df_topic_sim = pd.DataFrame(cosine_similarity(component), columns=topic_names) 
-    df_topic_sim["topic"] = topic_names 
 
-    # Convert into long table. 
-    df_topic_sim = df_topic_sim.melt(
-        id_vars="topic", value_vars=topic_names, var_name="to_compare", value_name="topic_similarity"
-    ) 
 
-    return df_topic_sim 
+# %%
+class OnlineNMF(BaseEstimator, TransformerMixin): 
+    def __init__(self, n_components:int=PARAM_N_TOPIC, batch_size:int=1024, forget_factor:float=0.9, max_iter:int=200, update_iter:int=10, n_epochs:int=5, tol:float=1e-4, random_state:int=PARAM_SEED): 
+        '''
+        NMF (Frobenius loss) updated with mini-batches, for refreshing the topics 
+        as new articles arrive instead of refitting on the whole corpus. For each 
+        batch, the document-topic weights are solved with the components fixed, 
+        then the sufficient statistics (A = W'X, B = W'W) are accumulated with 
+        the older batches down-weighted by (forget_factor), and the components 
+        take (update_iter) multiplicative updates from them. After each update, 
+        the topics are matched to the previous components (Hungarian matching on 
+        the cosine similarity) so that a topic keeps its ID. 
+
+        Use (from_model) to continue from a fitted (sklearn.decomposition.NMF). 
+        '''
+        self.n_components = n_components 
+        self.batch_size = batch_size 
+        self.forget_factor = forget_factor 
+        self.max_iter = max_iter 
+        self.update_iter = update_iter 
+        self.n_epochs = n_epochs 
+        self.tol = tol 
+        self.random_state = random_state 
+
+    @classmethod 
+    def from_model(cls, model:NMF, **kwargs): 
+        '''Start from the components of a fitted NMF, e.g. the current topic model.'''
+
+        online = cls(n_components=model.components_.shape[0], **kwargs) 
+        online._init_state(np.array(model.components_, dtype=np.float64)) 
+        return online 
+
+    def fit(self, X, y=None): 
+        for attr in ("components_", "stat_a_", "stat_b_", "n_samples_seen_", "n_features_in_"): 
+            self.__dict__.pop(attr, None) 
+
+        for _ in range(self.n_epochs): 
+            self.partial_fit(X) 
+        return self 
+
+    def partial_fit(self, X, y=None): 
+        '''Update the topics with the new documents, in batches of (batch_size).'''
+
+        X = sparse.csr_matrix(X, dtype=np.float64) 
+        if not hasattr(self, "components_"): 
+            self._init_state(self._init_components(X)) 
+
+        for batch in gen_batches(X.shape[0], self.batch_size): 
+            self._update(X[batch]) 
+        return self 
+
+    def transform(self, X) -> np.array: 
+        '''Document-topic weights of (X) with the components fixed.'''
+
+        check_is_fitted(self, "components_") 
+        return self._solve_weights(sparse.csr_matrix(X, dtype=np.float64)) 
+
+    def align_to(self, components:np.array) -> np.array: 
+        '''
+        Reorder the topics to best match the reference (components) and return 
+        the permutation applied (new position -> old position). 
+        '''
+        similarity = cosine_similarity(components, self.components_) 
+        _, order = linear_sum_assignment(similarity, maximize=True) 
+
+        self.components_ = self.components_[order] 
+        self.stat_a_ = self.stat_a_[order] 
+        self.stat_b_ = self.stat_b_[np.ix_(order, order)] 
+        return order 
+
+    def _update(self, X): 
+        previous = self.components_.copy() 
+        W = self._solve_weights(X) 
+
+        # Accumulate the sufficient statistics, forgetting the older batches. 
+        self.stat_a_ = self.forget_factor * self.stat_a_ + np.asarray(X.T @ W).T 
+        self.stat_b_ = self.forget_factor * self.stat_b_ + W.T @ W 
+        self.n_samples_seen_ += X.shape[0] 
+
+        # Multiplicative updates of the components. The zeros are lifted so that 
+        # the entities first seen in this batch can join the topics. 
+        H = np.maximum(self.components_, 1e-10) 
+        for _ in range(self.update_iter): 
+            H *= self.stat_a_ / np.maximum(self.stat_b_ @ H, 1e-10) 
+        self.components_ = H 
+
+        # Keep the topic IDs stable. 
+        self.align_to(previous) 
+
+    def _solve_weights(self, X) -> np.array: 
+        H = self.components_ 
+        HHt = H @ H.T 
+        XHt = np.asarray(X @ H.T) 
+
+        # Start from a uniform guess at the scale of the data, as sklearn does. 
+        rng = check_random_state(self.random_state) 
+        scale = np.sqrt(X.mean() / self.n_components) if X.nnz else 0.0 
+        W = scale * rng.uniform(0.5, 1.0, size=(X.shape[0], self.n_components)) 
+
+        for _ in range(self.max_iter): 
+            W_prev = W 
+            W = W * XHt / np.maximum(W @ HHt, 1e-10) 
+            if np.linalg.norm(W - W_prev) <= self.tol * max(np.linalg.norm(W_prev), 1e-10): 
+                break 
+        return W 
+
+    def _init_components(self, X) -> np.array: 
+        model = NMF(n_components=self.n_components, init="nndsvd", random_state=self.random_state, max_iter=self.max_iter) 
+        model.fit(X[:self.batch_size]) 
+        return np.array(model.components_, dtype=np.float64) 
+
+    def _init_state(self, components:np.array): 
+        self.components_ = components 
+        self.n_features_in_ = components.shape[1] 
+        self.stat_a_ = np.zeros_like(components) 
+        self.stat_b_ = np.zeros((components.shape[0], components.shape[0])) 
+        self.n_samples_seen_ = 0 
 
 
 
 # %%
-def get_token_weight(component:np.array, feature_names:np.array) -> pd.DataFrame: 
-    '''Get token weights for each token name for each topic.''' 
+def get_topic_similarity(component:np.array) -> pd.DataFrame: 
+    '''
+    Get cosine similarity score between each pair of topics. The components 
+    may be sparse, only the (topic x topic) scores are dense. 
+    '''
+    # Topic names. 
+    n_topic = component.shape[0] 
+    topic_names = np.array([f"TP{topic_i}" for topic_i in range(0, n_topic)], dtype=object) 
 
-    topic_key_tokens = defaultdict(lambda: {}) 
+    # Compute cosine similarity score on the L2-normalized components. 
+    component = normalize(component, norm="l2") 
+    similarity = component @ component.T 
+    similarity = similarity.toarray() if sparse.issparse(similarity) else np.asarray(similarity) 
 
-    # # To store the coherance scores.
-    # coherence_scores = [] 
+    # Lay out as a long table, (to_compare) by (to_compare). 
+    df_topic_sim = pd.DataFrame({
+        "topic"            : np.tile(topic_names, n_topic), 
+        "to_compare"       : np.repeat(topic_names, n_topic), 
+        "topic_similarity" : similarity.T.ravel(), 
+    }) 
 
-    # Topic names. 
-    topic_names = [f"TP{topic_i}" for topic_i in range(0, PARAM_N_TOPIC)] 
-
-    # Evaluate the topic clustering outcome. 
-    for topic_index in range(0, PARAM_N_TOPIC): 
-        # Find the top N terms for each topic. 
-        top_indices = np.argsort(component[topic_index, :])[::-1] 
+    return df_topic_sim 
 
-        # Token names that are related to specific topic. 
-        topic_terms = [feature_names[term_index] for term_index in top_indices[:PARAM_TOP_N_TERM]] 
-        topic_key_tokens[topic_index]["topic_terms"] = topic_terms 
 
-        # Token weight related to specific topic. 
-        token_weight = [component[topic_index, term_index] for term_index in top_indices[:PARAM_TOP_N_TERM]] 
-        topic_key_tokens[topic_index]["token_weight"] = token_weight 
 
-        # # Compute the coherence score. Need to use embeddings. 
-        # coherence_scores.append(topical_coherence(topic_terms)) 
+# %%
+def get_token_weight(component:np.array, feature_names:np.array) -> pd.DataFrame: 
+    '''
+    Get token weights for each token name for each topic. The top N terms of 
+    every topic are selected at once with a partial sort. 
+    '''
+    component = component.toarray() if sparse.issparse(component) else np.asarray(component) 
+    feature_names = np.asarray(feature_names, dtype=object) 
 
-    df_token_weight = pd.DataFrame(topic_key_tokens).T 
-    df_token_weight["topic"] = topic_names 
-    df_token_weight = df_token_weight.explode(column=["topic_terms", "token_weight"]) 
+    # Topic names. 
+    n_topic, n_token = component.shape 
+    n_term = min(PARAM_TOP_N_TERM, n_token) 
+    topic_names = np.array([f"TP{topic_i}" for topic_i in range(0, n_topic)], dtype=object) 
+
+    # Find the top N terms for each topic, then order them by weight. 
+    top_indices = np.argpartition(-component, n_term - 1, axis=1)[:, :n_term] 
+    top_weights = np.take_along_axis(component, top_indices, axis=1) 
+    order = np.argsort(-top_weights, axis=1, kind="stable") 
+    top_indices = np.take_along_axis(top_indices, order, axis=1) 
+    top_weights = np.take_along_axis(top_weights, order, axis=1) 
+
+    # One row per (topic, term), indexed by the topic index. 
+    df_token_weight = pd.DataFrame({
+        "topic_terms"  : feature_names[top_indices].ravel(), 
+        "token_weight" : top_weights.ravel(), 
+        "topic"        : np.repeat(topic_names, n_term), 
+    }, index=np.repeat(np.arange(n_topic), n_term)) 
 
     return df_token_weight 
 
@@ -185,18 +440,27 @@ def get_token_weight(component:np.array, feature_names:np.array) -> pd.DataFrame
 def get_center_component(headline_id:np.array, latent_feature:np.array) -> pd.DataFrame: 
     '''Get the center value of the component for each topic.''' 
 
+    latent_feature = np.asarray(latent_feature) 
+
     # Topic names. 
-    topic_names = [f"TP{topic_i}" for topic_i in range(0, PARAM_N_TOPIC)] 
+    n_topic = latent_feature.shape[1] 
+    topic_names = [f"TP{topic_i}" for topic_i in range(0, n_topic)] 
 
     # Get the topic cluster label. 
     latent_topic = np.argmax(latent_feature, axis=1) 
 
-    # Reorganise the data in dataframe. 
-    df_latent_feature = pd.DataFrame(data=latent_feature, columns=topic_names) 
-    df_center_component = pd.DataFrame(data={"headline_id": headline_id, "topic": latent_topic}) 
-    df_center_component = pd \
-        .concat([df_center_component, df_latent_feature], axis="columns") \
-        .loc[:,"topic":].groupby("topic").mean() 
+    # Sum the features of each cluster with a (cluster x document) indicator 
+    # matrix and divide by the cluster sizes. 
+    counts = np.bincount(latent_topic, minlength=n_topic) 
+    indicator = sparse.csr_matrix(
+        (np.ones(latent_topic.size), (latent_topic, np.arange(latent_topic.size))), shape=(n_topic, latent_topic.size) 
+    ) 
+    present = np.flatnonzero(counts) 
+    centers = np.asarray(indicator @ latent_feature)[present] / counts[present, None] 
+
+    df_center_component = pd.DataFrame(
+        data=centers, columns=topic_names, index=pd.Index(present, name="topic") 
+    ) 
 
     return df_center_component 
 
@@ -242,8 +506,11 @@ def get_token_variation(row:pd.Series) -> list:
 
 
 # %% 
-def replace_references(row:pd.Series) -> str: 
-	'''Replace specific text with entities title.''' 
+def replace_references(row:pd.Series, verbose:bool=False) -> str: 
+	'''
+	Replace specific text with entities title. All the strings of an article are 
+	combined into one pattern, so the article is rewritten in a single pass. 
+	''' 
 	
 	ent_title = row["entities"]["title"] 
 	token_variation = row["token_variation"] 
@@ -256,12 +523,24 @@ def replace_references(row:pd.Series) -> str:
 	if isinstance(token_variation, type(None)): 
 		return None 
 
+	# Map each string to be replaced to its entity title. The first entity 
+	# keeps the string if several entities share it. 
+	replacements = dict() 
 	for i, span_token in enumerate(token_variation): 
-		# Replace strings with the given entity title. 
+		title_phrase = ent_title[i].strip().replace(" ", "_") 
 		for to_be_replaced in span_token: 
-			title_phrase = ent_title[i].strip().replace(" ", "_") 
-			body_text = re.sub(f"\\b{to_be_replaced}\\b", title_phrase, body_text) 
+			replacements.setdefault(to_be_replaced, title_phrase) 
+
+			if verbose: 
+				print(to_be_replaced, " >> ", title_phrase) 
+		if verbose: 
+			print("-----" * 5) 
+
+	if not replacements: 
+		return body_text 
+
+	# Longer strings go first so that the alternation matches the longest one. 
+	to_be_replaced = sorted(replacements, key=len, reverse=True) 
+	pattern = re.compile(r"\b(?:" + "|".join(re.escape(token) for token in to_be_replaced) + r")\b") 
 
-			print(to_be_replaced, " >> ", title_phrase) 
-		print("-----" * 5) 
-	return body_text 
+	return pattern.sub(lambda match: replacements[match.group(0)], body_text) 
@@ -0,0 +1,364 @@
+# %%
+# Python modules.
+import os, re, time, json, random, socket, threading
+import urllib.parse, urllib.error
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+# Custom modules.
+from source.modules.manage_cache import ManageCache
+from source.modules.processor_topic import get_wikifier_params, parse_wikifier_response
+
+# Custom configs.
+from source.config_py.config import (
+    WIKIFIER_URL, PARAM_THRESHOLD, PARAM_LANG,
+    PARAM_WIKIFIER_WORKERS, PARAM_WIKIFIER_RATE, PARAM_WIKIFIER_BURST,
+    PARAM_WIKIFIER_RETRIES, PARAM_WIKIFIER_BACKOFF, PARAM_WIKIFIER_CHUNK,
+    PARAM_WIKIFIER_MAX_CHARS
+)
+
+
+
+# %%
+class TokenBucket():
+    def __init__(self, rate:float=PARAM_WIKIFIER_RATE, capacity:int=PARAM_WIKIFIER_BURST):
+        '''
+        Thread-safe token bucket. Tokens are refilled at (rate) per second up to
+        (capacity) and each request takes one token, waiting if none is left.
+        '''
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                # Refill the tokens for the elapsed time.
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                # Time until the next token is available.
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+
+# %%
+class TransientError(Exception):
+    '''Raised for responses that are worth retrying (rate limit or server errors).'''
+
+
+
+# %%
+class WikifierClient():
+    def __init__(self, url:str=WIKIFIER_URL, n_workers:int=PARAM_WIKIFIER_WORKERS, rate:float=PARAM_WIKIFIER_RATE, burst:int=PARAM_WIKIFIER_BURST, max_retries:int=PARAM_WIKIFIER_RETRIES, backoff:float=PARAM_WIKIFIER_BACKOFF, timeout:int=60, max_chars:int=PARAM_WIKIFIER_MAX_CHARS):
+        '''
+        Concurrent Wikifier client. Each worker thread keeps its own keep-alive
+        connection, the rate limit is enforced by a shared token bucket and the
+        transient failures are retried with exponential backoff. Point (url) to
+        a local HTTP server to test it without the real API.
+
+        Articles longer than (max_chars) are split on sentence boundaries, the
+        chunks are sent concurrently and their annotations are merged back with
+        the character offsets shifted to the original text. Set (max_chars) to
+        None to send the articles as they are.
+        '''
+        self.url = url
+        self.n_workers = n_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.max_chars = max_chars
+        self.bucket = TokenBucket(rate=rate, capacity=burst)
+        self._local = threading.local()
+        self._executor = None
+
+        # Split the URL once for the connections.
+        parts = urllib.parse.urlsplit(url)
+        self._scheme, self._host, self._port = parts.scheme, parts.hostname, parts.port
+        self._path = parts.path or "/"
+
+    def request(self, text:str, lang:str=PARAM_LANG, threshold:int=PARAM_THRESHOLD, params:list=None) -> dict:
+        '''Send one article and return the raw JSON response.'''
+
+        params = params if params is not None else get_wikifier_params(text, lang=lang, threshold=threshold)
+        body = urllib.parse.urlencode(params).encode("utf8")
+
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                return self._post(body)
+            except (TransientError, http.client.HTTPException, ConnectionError, socket.timeout) as e:
+                # Drop the broken connection, a new one is opened on the next attempt.
+                if not isinstance(e, TransientError):
+                    self._close()
+                if attempt == self.max_retries:
+                    raise
+
+                # Exponential backoff with jitter.
+                wait = self.backoff * (2 ** attempt) * (1 + random.random())
+                print(f"Retry ({attempt + 1}/{self.max_retries}) in ({wait:.1f}s) after: {e}")
+                time.sleep(wait)
+
+    def extract(self, text:str, lang:str=PARAM_LANG, threshold:int=PARAM_THRESHOLD) -> dict:
+        '''Get the entities and POS tags for one article.'''
+
+        return parse_wikifier_response(self.request_many([text], lang=lang, threshold=threshold)[0])
+
+    def request_many(self, texts:list, lang:str=PARAM_LANG, threshold:int=PARAM_THRESHOLD) -> list:
+        '''Send the articles concurrently and return the raw responses in input order.'''
+
+        # Split the long articles and send every chunk through the same pool.
+        chunks = [split_sentences(text, self.max_chars) if self.max_chars else [(0, text)] for text in texts]
+        flat = [chunk for article in chunks for _, chunk in article]
+
+        # Reuse the same worker threads, so that their connections stay alive across calls.
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.n_workers)
+        flat = list(self._executor.map(lambda text: self.request(text, lang=lang, threshold=threshold), flat))
+
+        # Regroup the chunk responses per article.
+        responses, pos = [], 0
+        for article in chunks:
+            if len(article) == 1:
+                responses.append(flat[pos])
+            else:
+                responses.append(merge_wikifier_responses(flat[pos:pos+len(article)], [offset for offset, _ in article]))
+            pos += len(article)
+        return responses
+
+    def extract_many(self, texts:list, lang:str=PARAM_LANG, threshold:int=PARAM_THRESHOLD) -> list:
+        '''Get the entities and POS tags for the articles in input order.'''
+
+        return [parse_wikifier_response(response) for response in self.request_many(texts, lang=lang, threshold=threshold)]
+
+    def close(self):
+        '''Stop the worker threads.'''
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._close()
+
+    def _post(self, body:bytes) -> dict:
+        conn = self._connection()
+        conn.request("POST", self._path, body=body, headers={
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Connection": "keep-alive",
+        })
+
+        # Read the whole response so that the connection can be reused.
+        response = conn.getresponse()
+        payload = response.read()
+
+        if response.status == 429 or response.status >= 500:
+            raise TransientError(f"HTTP ({response.status}) from Wikifier.")
+        if response.status >= 400:
+            raise urllib.error.HTTPError(self.url, response.status, response.reason, response.headers, None)
+        return json.loads(payload.decode("utf8"))
+
+    def _connection(self) -> http.client.HTTPConnection:
+        '''Get the keep-alive connection of the current thread.'''
+
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn_class = http.client.HTTPSConnection if self._scheme == "https" else http.client.HTTPConnection
+            conn = conn_class(self._host, self._port, timeout=self.timeout)
+            self._local.conn = conn
+        return conn
+
+    def _close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+
+# %%
+def split_sentences(text:str, max_chars:int=PARAM_WIKIFIER_MAX_CHARS) -> list:
+    '''
+    Split the text on sentence boundaries into chunks of at most (max_chars)
+    characters. Returns a list of (offset, chunk) where (offset) is the position
+    of the chunk in the original text. A single sentence longer than the limit
+    is split on the last whitespace before the limit.
+    '''
+    if len(text) <= max_chars:
+        return [(0, text)]
+
+    # End positions of each sentence, including the trailing whitespace.
+    bounds = [m.end() for m in re.finditer(r"[.!?]+[\"')\]]*\s+", text)] + [len(text)]
+
+    chunks, chunk_beg, last = [], 0, 0
+    for end in bounds:
+        # Close the chunk before the sentence that would overflow it.
+        if end - chunk_beg > max_chars and last > chunk_beg:
+            chunks.append((chunk_beg, text[chunk_beg:last]))
+            chunk_beg = last
+
+        # Cut a sentence that does not fit in a chunk by itself.
+        while end - chunk_beg > max_chars:
+            cut = text.rfind(" ", chunk_beg, chunk_beg + max_chars)
+            cut = cut + 1 if cut > chunk_beg else chunk_beg + max_chars
+            chunks.append((chunk_beg, text[chunk_beg:cut]))
+            chunk_beg = cut
+        last = end
+
+    if chunk_beg < len(text):
+        chunks.append((chunk_beg, text[chunk_beg:]))
+    return chunks
+
+
+
+# %%
+def merge_wikifier_responses(responses:list, offsets:list) -> dict:
+    '''
+    Merge the responses of the chunks of one article. The (support) character
+    offsets are shifted to the original text and the annotations are deduplicated
+    by (wikiDataItemId), or by title when the item ID is missing. If any chunk
+    failed (no annotations), its response is returned as it is, so the whole
+    article is retried rather than cached with the entities of some chunks only.
+    '''
+    # Keep the first failed response as it is.
+    for response in responses:
+        if "annotations" not in response:
+            return response
+
+    merged = {"annotations": [], "verbs": [], "nouns": [], "adjectives": [], "adverbs": []}
+    annotations = dict()
+
+    for response, offset in zip(responses, offsets):
+        # Keep the POS tags of every chunk.
+        for postag in ["verbs", "nouns", "adjectives", "adverbs"]:
+            merged[postag].extend(response.get(postag) or [])
+
+        for annotation in response.get("annotations") or []:
+            support = [
+                dict(span, chFrom=span["chFrom"] + offset, chTo=span["chTo"] + offset)
+                for span in annotation.get("support") or []
+            ]
+
+            # Extend the supports of an entity already found in a previous chunk.
+            key = annotation.get("wikiDataItemId") or annotation.get("title")
+            if key in annotations:
+                annotations[key]["support"].extend(support)
+            else:
+                annotations[key] = dict(annotation, support=support)
+
+    merged["annotations"] = list(annotations.values())
+    return merged
+
+
+
+# %%
+def get_response_cache() -> ManageCache:
+    '''
+    Persistent cache of the raw Wikifier responses. Nothing is evicted since
+    every entry stands for a paid API call.
+    '''
+    return ManageCache(model_version="wikifier", filename="wikifier_cache.sqlite", max_entries=None)
+
+
+
+# %%
+def get_response_key(cache:ManageCache, text:str, lang:str=PARAM_LANG, threshold:int=PARAM_THRESHOLD) -> str:
+    '''Hash the text and the request parameters (without the user key) into a cache key.'''
+
+    params = [(name, value) for name, value in get_wikifier_params(text, lang=lang, threshold=threshold, user_key="") if name != "userKey"]
+    return cache.make_key(params, namespace="wikifier")
+
+
+
+# %%
+def wikifier_enrich(texts:pd.Series, client:WikifierClient, cache:ManageCache=None, checkpoint:str="wikifier_checkpoint.log", lang:str=PARAM_LANG, threshold:int=PARAM_THRESHOLD, chunk_size:int=PARAM_WIKIFIER_CHUNK) -> pd.DataFrame:
+    '''
+    Get the entities and POS tags for each article (indexed by headline ID). Only
+    the articles missing from the response cache are sent. The responses are stored
+    chunk by chunk and the completed headline IDs are appended to the (checkpoint)
+    log, so a crash resumes from the last completed chunk. The responses without
+    annotations (API errors) are neither cached nor checkpointed, so they are sent
+    again on the next run.
+    '''
+    cache = cache if cache is not None else get_response_cache()
+    keys = pd.Series([get_response_key(cache, text, lang, threshold) for text in texts], index=texts.index)
+
+    # Skip the articles completed in the previous runs or already cached.
+    completed = read_checkpoint(cache, checkpoint)
+    pending = [i for i, key in keys.items() if completed.get(i) != key]
+    found = cache.get_many(list(dict.fromkeys(keys[pending])))
+    pending = [i for i in pending if keys[i] not in found]
+    print(f"Wikifier: ({len(texts) - len(pending)}) articles cached, ({len(pending)}) to request.")
+
+    for beg in range(0, len(pending), chunk_size):
+        chunk = pending[beg:beg+chunk_size]
+        responses = client.request_many(texts[chunk].to_list(), lang=lang, threshold=threshold)
+
+        # Store the chunk before marking it as completed. The failed responses
+        # (without annotations) are left pending so the next run retries them.
+        done = [(i, response) for i, response in zip(chunk, responses) if "annotations" in response]
+        done_ids = [i for i, _ in done]
+        cache.set_many(keys[done_ids].to_list(), [response for _, response in done])
+        write_checkpoint(cache, checkpoint, done_ids, keys[done_ids].to_list())
+        print(f"Wikifier: completed ({beg + len(chunk)}/{len(pending)}), ({len(chunk) - len(done)}) failed.")
+
+    return rebuild_from_cache(texts, cache=cache, lang=lang, threshold=threshold)
+
+
+
+# %%
+def rebuild_from_cache(texts:pd.Series, cache:ManageCache=None, lang:str=PARAM_LANG, threshold:int=PARAM_THRESHOLD) -> pd.DataFrame:
+    '''
+    Rebuild the (entities) and (pos_tags) columns from the response cache without
+    any network call. Articles missing from the cache get empty results.
+    '''
+    cache = cache if cache is not None else get_response_cache()
+    keys = [get_response_key(cache, text, lang, threshold) for text in texts]
+    found = cache.get_many(list(dict.fromkeys(keys)))
+
+    results = [parse_wikifier_response(found.get(key, {})) for key in keys]
+    return pd.DataFrame({
+        "entities"  : [result["entities"] for result in results],
+        "pos_tags"  : [result["pos_tags"] for result in results],
+    }, index=texts.index)
+
+
+
+# %%
+def read_checkpoint(cache:ManageCache, checkpoint:str) -> dict:
+    '''Read the completed (headline ID, cache key) pairs from the checkpoint log.'''
+
+    path = os.path.join(cache.dataset_dir, checkpoint)
+    if not os.path.exists(path):
+        return dict()
+
+    completed = dict()
+    with open(path, "r") as f:
+        for line in f:
+            # Ignore a partially written last line after a crash.
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            completed[record["headline_id"]] = record["key"]
+    return completed
+
+
+
+# %%
+def write_checkpoint(cache:ManageCache, checkpoint:str, headline_ids:list, keys:list):
+    '''Append the completed headline IDs to the checkpoint log.'''
+
+    path = os.path.join(cache.dataset_dir, checkpoint)
+    with open(path, "a") as f:
+        for headline_id, key in zip(headline_ids, keys):
+            f.write(json.dumps({"headline_id": headline_id, "key": key}, default=lambda o: o.item() if hasattr(o, "item") else str(o)) + "\n")
+        f.flush()
+        os.fsync(f.fileno())